@@ -35,6 +35,8 @@ from urllib.parse import urlparse
 from itertools import combinations
 
 import numpy as np
+import rasterio
+from rasterio.windows import Window
 
 import multiprocessing
 from multiprocessing import Pool
@@ -271,44 +273,91 @@ def check_dem_valid_per(dem_tif_list, work_dir, process_num =1, move_dem_thresho
 
     return keep_dem_list
 
-def read_date_dem_to_memory(pair_idx, pair, date_pair_list_sorted,dem_data_dict, dem_groups_date, less_memory=False):
+def get_dem_diff_block_windows(height, width, block_size):
+    '''
+    split the DEM extent into square blocks, aligned to the 256 by 256 tiles of the outputs
+    :param height: height of the DEMs
+    :param width: width of the DEMs
+    :param block_size: block size in pixels, a multiple of 256
+    :return: a list of Window
+    '''
+    windows = []
+    for yoff in range(0, height, block_size):
+        for xoff in range(0, width, block_size):
+            windows.append(Window(xoff, yoff, min(block_size, width - xoff), min(block_size, height - yoff)))
+    return windows
 
-    if less_memory is False:
-        # read data to memory if need, then store in memory, avoid to read them again.
-        # for a large area, because we read all raster to memory, it will cause "out of memory problem"
-        if pair[0] not in dem_data_dict.keys():
-            data_old, _ = raster_io.read_raster_one_band_np(dem_groups_date[pair[0]][0])
-            dem_data_dict[pair[0]] = data_old
-        else:
-            data_old = dem_data_dict[pair[0]]
+def read_dem_block(dem_tif, window):
+    '''
+    read a block of a DEM, nodata pixels are set as nan
+    :param dem_tif: the DEM file
+    :param window: the Window of the block
+    :return: a 2D float32 array
+    '''
+    with rasterio.open(dem_tif) as src:
+        data = src.read(1, window=window).astype(np.float32)
+        if src.nodata is not None and np.isnan(src.nodata) == False:
+            data[data == src.nodata] = np.nan
+    return data
 
-        # read data to memory if need
-        if pair[1] not in dem_data_dict.keys():
-            data_new, _ = raster_io.read_raster_one_band_np(dem_groups_date[pair[1]][0])
-            dem_data_dict[pair[1]] = data_new
-        else:
-            data_new = dem_data_dict[pair[1]]
-    else:
-        # if we don't have enough memory, don't store the all DEM data in memory, only read two needed.
-        # wil increase reading operation from disk
-        data_old, _ = raster_io.read_raster_one_band_np(dem_groups_date[pair[0]][0])
-        data_new, _ = raster_io.read_raster_one_band_np(dem_groups_date[pair[1]][0])
+def dem_diff_one_block(window, dem_tif_list, date_pair_idx_list):
+    '''
+    get DEM difference of a block, for each pixel, use the pair of DEMs with the largest day difference
+    :param window: the Window of the block
+    :param dem_tif_list: DEM files, one for each date
+    :param date_pair_idx_list: a list of (old idx, new idx, day difference), sorted by day difference (from max to min)
+    :return: window, DEM difference (float32), date difference (uint16)
+    '''
+    date_diff_np = np.zeros((window.height, window.width), dtype=np.uint16)
+    dem_diff_np = np.empty((window.height, window.width), dtype=np.float32)
+    dem_diff_np[:] = np.nan
 
-    # release some memory if we can (NO)
+    # only read the DEMs (dates) needed by this block, each one at most once
+    dem_data_dict = {}
+    for old_idx, new_idx, diff_days in date_pair_idx_list:
+        for idx in [old_idx, new_idx]:
+            if idx not in dem_data_dict.keys():
+                dem_data_dict[idx] = read_dem_block(dem_tif_list[idx], window)
+
+        diff_two = dem_data_dict[new_idx] - dem_data_dict[old_idx]
+
+        # fill the element
+        new_ele = np.where(np.logical_and(np.isnan(dem_diff_np), ~np.isnan(diff_two)))
+        dem_diff_np[new_ele] = diff_two[new_ele]
+        date_diff_np[new_ele] = diff_days
 
-    return data_old, data_new
+        # check if all have been filled ( nan pixels)
+        if np.isnan(dem_diff_np).any() == False:
+            break
+
+    return window, dem_diff_np, date_diff_np
 
+def dem_diff_one_block_star(args):
+    return dem_diff_one_block(*args)
 
-def dem_diff_newest_oldest(dem_tif_list, out_dem_diff, out_date_diff):
+def get_dem_diff_profile(ref_src, dtype, nodata):
+    # a tiled GeoTIFF, using the first DEM as reference
+    profile = ref_src.profile
+    profile.update(driver='GTiff', dtype=dtype, count=1, nodata=nodata, tiled=True, blockxsize=256, blockysize=256,
+                   compress='lzw', BIGTIFF='IF_SAFER')
+    return profile
+
+def dem_diff_newest_oldest(dem_tif_list, out_dem_diff, out_date_diff, process_num=1, block_size=1024):
     '''
     get DEM difference, for each pixel, newest vaild value - oldest valid value
-    :param dem_list:
-    :param output:
-    :return:
+    the DEMs are processed block by block, so the memory is proportional to block_size x block_size x the number of dates
+    :param dem_tif_list: DEM files (the same width and height)
+    :param out_dem_diff: the output of DEM difference (float32, meter)
+    :param out_date_diff: the output of date difference (uint16, days)
+    :param process_num: the number of processes for computing blocks
+    :param block_size: block size in pixels, a multiple of 256 (the tile size of the outputs)
+    :return: True if successful, False otherwise
     '''
     if len(dem_tif_list) < 2:
         basic.outputlogMessage('error, the count of DEM is smaller than 2')
         return False
+    if block_size < 256 or block_size % 256 != 0:
+        raise ValueError('block_size (%d) should be a multiple of 256' % block_size)
 
 
     # groups DEM with original images acquired at the same year months
@@ -333,72 +382,50 @@ def dem_diff_newest_oldest(dem_tif_list, out_dem_diff, out_date_diff):
 
     tif_obj_list = None
 
-    # read all and their date
-    date_pair_list = list(combinations(date_list, 2))
-    date_diff_list = [ (item[1] - item[0]).days for item in date_pair_list ]
-    # sort based on day difference (from max to min)
-    date_pair_list_sorted = [x for _, x in sorted(zip(date_diff_list, date_pair_list),reverse=True)]    # descending
-
-    # use dict to read data from disk (only need)
-    dem_data_dict = {}
-
-    # get the difference
-    date_diff_np = np.zeros((height, width),dtype=np.uint16)
-    dem_diff_np = np.empty((height, width),dtype=np.float32)
-    dem_diff_np[:] = np.nan
-
-    for p_idx, pair in enumerate(date_pair_list_sorted):
-        diff_days = (pair[1] - pair[0]).days
-        basic.outputlogMessage('Getting DEM difference using the one on %s and %s, total day diff: %d'%
-                               (timeTools.date2str(pair[1]), timeTools.date2str(pair[0]),diff_days))
-        # print(pair,':',(pair[1] - pair[0]).days)
-
-        data_old, data_new = read_date_dem_to_memory(p_idx, pair, date_pair_list_sorted,dem_data_dict, dem_groups_date)
-
-        print('data_old shape:',data_old.shape)
-        print('data_new shape:',data_new.shape)
-
-        diff_two = data_new - data_old
-        # print(diff_two)
-
-        # fill the element
-        new_ele = np.where(np.logical_and( np.isnan(dem_diff_np), ~np.isnan(diff_two)))
-        dem_diff_np[ new_ele ] = diff_two[new_ele]
-
-        date_diff_np[new_ele] = diff_days
-
-        # check if all have been filled ( nan pixels)
-        diff_remain_hole = np.where(np.isnan(dem_diff_np))
-        basic.outputlogMessage(' remain %.4f percent pixels need to be filled'% (100.0*diff_remain_hole[0].size/dem_diff_np.size) )
-        if diff_remain_hole[0].size < 1:
-            break
-
-        # # test
-        # break
-    # save date diff to tif (16 bit)
-    raster_io.save_numpy_array_to_rasterfile(date_diff_np,out_date_diff,dem_tif_list[0], nodata=0,compress='lzw',tiled='yes',bigtiff='if_safer')
-
-    # # stretch the DEM difference, save to 8 bit.
-    # dem_diff_np_8bit = raster_io.image_numpy_to_8bit(dem_diff_np,10,-10,dst_nodata=0)
-    # out_dem_diff_8bit = io_function.get_name_by_adding_tail(out_dem_diff, '8bit')
-    # raster_io.save_numpy_array_to_rasterfile(dem_diff_np_8bit, out_dem_diff_8bit, dem_tif_list[0], nodata=0)
-
-
-    # if possible, save to 16 bit, to save the disk storage.
-    # dem_diff_np[0:5,0] = -500
-    # dem_diff_np[0,0:5] = 500
-    # print(np.nanmin(dem_diff_np))
-    # print(np.nanmax(dem_diff_np))
-    range = np.iinfo(np.int16)
-    # dem_diff_np_cm = dem_diff_np*100
-    # if np.nanmin(dem_diff_np_cm) < range.min or np.nanmax(dem_diff_np_cm) > range.max:
-    # save dem diff to files (float), meter
-    raster_io.save_numpy_array_to_rasterfile(dem_diff_np,out_dem_diff,dem_tif_list[0],nodata=-9999,compress='lzw',tiled='yes',bigtiff='if_safer')
-    # else:
-    #     # save dem diff to 16bit, centimeter, only handle diff from -327.67 to 327.67 meters
-    #     dem_diff_np_cm = dem_diff_np_cm.astype(np.int16)        # save to int16
-    #     raster_io.save_numpy_array_to_rasterfile(dem_diff_np_cm, out_dem_diff_cm, dem_tif_list[0],nodata=32767,compress='lzw',tiled='yes',bigtiff='if_safer')
-
+    # all the pairs and their date difference
+    date_pair_idx_list = [ (i_old, i_new, (date_list[i_new] - date_list[i_old]).days)
+                           for i_old, i_new in combinations(range(len(date_list)), 2)]
+    # sort based on day difference (from max to min), for the same day difference, the pair with later dates first
+    date_pair_idx_list = sorted(date_pair_idx_list, key=operator.itemgetter(2, 0, 1), reverse=True)    # descending
+
+    windows = get_dem_diff_block_windows(height, width, block_size)
+    basic.outputlogMessage('Getting DEM difference from %d dates (%d pairs), %d blocks of %d by %d pixels' %
+                           (len(date_list), len(date_pair_idx_list), len(windows), block_size, block_size))
+
+    with rasterio.open(dem_tif_list[0]) as ref_src:
+        # save date diff to tif (16 bit), and dem diff to files (float), meter
+        date_diff_profile = get_dem_diff_profile(ref_src, rasterio.uint16, 0)
+        dem_diff_profile = get_dem_diff_profile(ref_src, rasterio.float32, -9999)
+
+    if process_num < 1:
+        raise ValueError('Wrong process_num: %d' % process_num)
+
+    remain_hole_count = 0
+    theadPool = None
+    try:
+        with rasterio.open(out_date_diff, 'w', **date_diff_profile) as date_dst, \
+                rasterio.open(out_dem_diff, 'w', **dem_diff_profile) as dem_dst:
+            if process_num == 1:
+                results = (dem_diff_one_block(window, dem_tif_list, date_pair_idx_list) for window in windows)
+            else:
+                theadPool = Pool(process_num)  # multi processes
+                parameters_list = [(window, dem_tif_list, date_pair_idx_list) for window in windows]
+                # each block is written as soon as it is done, no full-size array in memory
+                results = theadPool.imap_unordered(dem_diff_one_block_star, parameters_list)
+
+            for b_idx, (window, dem_diff_np, date_diff_np) in enumerate(results):
+                date_dst.write(date_diff_np, 1, window=window)
+                dem_dst.write(dem_diff_np, 1, window=window)
+                remain_hole_count += np.count_nonzero(np.isnan(dem_diff_np))
+                if (b_idx + 1) % 100 == 0:
+                    print('processed %d / %d blocks' % (b_idx + 1, len(windows)))
+    finally:
+        # also stop the workers if a block failed
+        if theadPool is not None:
+            theadPool.terminate()
+            theadPool.join()
+
+    basic.outputlogMessage(' remain %.4f percent pixels have no DEM difference' % (100.0*remain_hole_count/(height*width)))
 
     return True
 
@@ -586,7 +613,7 @@ def proc_ArcticDEM_strip_one_grid_polygon(tar_dir,dem_polygons,dem_urls,o_res,sa
     if b_dem_diff:
         save_dem_diff = os.path.join(save_dir,pre_name + '_ArcticDEM_diff_sub_%d.tif'%extent_id)
         save_date_diff = os.path.join(save_dir,pre_name + '_date_diff_sub_%d.tif'%extent_id)
-        dem_diff_newest_oldest(dem_tif_list,save_dem_diff,save_date_diff)
+        dem_diff_newest_oldest(dem_tif_list,save_dem_diff,save_date_diff,process_num=process_num)
 
         pass
 
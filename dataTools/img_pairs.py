@@ -10,14 +10,28 @@ add time: 07 November, 2019
 
 import rasterio
 import os,sys
+import hashlib
+import copy
 
 import torch
 import numpy as np
-import random
+from numpy.lib.stride_tricks import sliding_window_view
 
 # indicate in the change map, what value indicate changes
 label_change_value = 1
 label_no_change_value = 0
+# the label of pixels for prediction (no label)
+label_unknown_value = 255
+
+# the index of one pixel sample: image pair id, row, column, and label
+pixel_index_dtype = np.dtype([('pair_id', np.uint16), ('row', np.int32), ('col', np.int32), ('label', np.uint8)])
+
+# the random seed for removing no-change pixels, then the training pixels (and the validation split) are the same
+# between runs, e.g., when resuming the training
+sample_random_seed = 1
+
+# hold out entire image pairs for validation only if there are at least this number of image pairs
+valid_pair_min_count = 5
 
 sys.path.insert(0,os.path.expanduser('~/codes/PycharmProjects/Landuse_DL'))
 from datasets.build_RS_data import patchclass
@@ -99,13 +113,150 @@ def save_image_oneband_8bit(ref_image_path,img_data,save_path, boundary=None):
 
     return True
 
+def get_pad_width(win_size):
+    '''
+    get the pad width of an image (nband, height, width), after padding, the patch of the pixel at (row, col)
+    is [:, row:row+win_height, col:col+win_width]
+    :param win_size: window size of the patches (height, width)
+    :return: pad width for np.pad
+    '''
+    pad_row = int(win_size[0] / 2)
+    pad_col = int(win_size[1] / 2)
+    return ((0, 0), (pad_row, win_size[0] - pad_row - 1), (pad_col, win_size[1] - pad_col - 1))
+
+def get_image_npy_cache(img_path, cache_dir, pad_width):
+    '''
+    save a padded image to a .npy file, which can be opened as a memory map. The file name contains a hash of
+    the image path, modified time, and pad width, so the cache will be rebuilt if the image is changed.
+    :param img_path: the image path
+    :param cache_dir: the folder for saving .npy files
+    :param pad_width: the pad width, see get_pad_width
+    :return: the path of the .npy file
+    '''
+    img_path = os.path.abspath(img_path)
+    key = '%s|%f|%s' % (img_path, os.path.getmtime(img_path), str(pad_width))
+    file_name = os.path.splitext(os.path.basename(img_path))[0]
+    npy_path = os.path.join(cache_dir, '%s_%s.npy' % (file_name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+    if os.path.isfile(npy_path):
+        return npy_path
+
+    if os.path.isdir(cache_dir) is False:
+        os.makedirs(cache_dir, exist_ok=True)
+    image_array = np.pad(read_image_to_array(img_path), pad_width, mode='constant', constant_values=0)
+    # write to a temporary file first, avoid other processes reading an incomplete file
+    tmp_path = npy_path + '.tmp%d' % os.getpid()
+    with open(tmp_path, 'wb') as f_obj:
+        np.save(f_obj, image_array)
+    os.replace(tmp_path, npy_path)
+    print('save %s to %s' % (img_path, npy_path))
+    return npy_path
+
 def get_image_height_width(image_path):
     with rasterio.open(image_path) as src:
         return src.height, src.width
 
+def read_image_pair_for_prediction(image_pair, subset_boundary=None):
+    '''
+    read the old and new image (or their subsets) of a pair to memory for prediction
+    :param image_pair: [old_image, new_image, label_path (if available)]
+    :param subset_boundary: the subset boundary of image  (xoff,yoff ,xsize, ysize) in pixel coordinate, None for entire image
+    :return: old_image_array, new_image_array, shape (ncount, height, width)
+    '''
+    check_image_pairs(image_pair)
+    old_img_path = image_pair[0]  # an old image
+    new_img_path = image_pair[1]  # a new image
+
+    if subset_boundary is None:
+        # read the entire image
+        old_image_array = read_image_to_array(old_img_path)
+        new_image_array = read_image_to_array(new_img_path)
+    else:
+        # only read the subset
+        old_subset = patchclass(old_img_path,subset_boundary)
+        new_subset = patchclass(new_img_path,subset_boundary)
+
+        old_image_array = read_patch(old_subset)
+        new_image_array = read_patch(new_subset)
+
+    return old_image_array, new_image_array
+
+def get_pixel_index_array(pair_id, height, width, label_data=None):
+    '''
+    get the index of all pixels in an image
+    :param pair_id: the id of the image pair
+    :param height: image height
+    :param width: image width
+    :param label_data: 2d label array (height, width), None for prediction
+    :return: a numpy structured array (pixel_index_dtype), in row-major order
+    '''
+    if pair_id > np.iinfo(pixel_index_dtype['pair_id']).max:
+        raise ValueError('error, the pair id: %d is too large'%pair_id)
+    pixel_index = np.empty(height * width, dtype=pixel_index_dtype)
+    rows, cols = np.indices((height, width), dtype=np.int32)
+    pixel_index['pair_id'] = pair_id
+    pixel_index['row'] = rows.ravel()
+    pixel_index['col'] = cols.ravel()
+    if label_data is None:
+        pixel_index['label'] = label_unknown_value
+    else:
+        b_unknown = (label_data != label_change_value) & (label_data != label_no_change_value)
+        if np.any(b_unknown):
+            row, col = np.argwhere(b_unknown)[0]
+            raise ValueError('Error: unknown label: %d at row: %d, col: %d' % (label_data[row, col], row, col))
+        pixel_index['label'] = label_data.ravel()
+    return pixel_index
+
+def get_batch_data_loader(dataset, batch_size, num_workers, shuffle):
+    '''
+    get a DataLoader which passes a list of indices (a batch) to the dataset at once,
+    so two_images_pixel_pair can extract all patches of a batch in one go (__getitems__), without collating single samples
+    :param dataset: a two_images_pixel_pair dataset
+    :param batch_size: the batch size
+    :param num_workers: the number of workers for loading images
+    :param shuffle: shuffle the samples or not
+    :return: a DataLoader
+    '''
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False)
+    # batch_size = None to disable automatic batching, each index from the sampler is a list of sample indices
+    return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batch_sampler, num_workers=num_workers)
+
+def split_train_validation(dataset, valid_ratio, seed=1):
+    '''
+    split the samples of a training dataset for training and validation. If there are enough image pairs
+    (valid_pair_min_count), hold out entire pairs (patches of neighbouring pixels overlap), otherwise, hold out random pixels.
+    :param dataset: a two_images_pixel_pair dataset for training
+    :param valid_ratio: the ratio of samples (or image pairs) for validation
+    :param seed: the random seed, keep the split the same between runs
+    :return: train_dataset, valid_dataset, sharing the images with dataset
+    '''
+    rng = np.random.RandomState(seed)
+    pair_ids = dataset.pixel_index_pairs['pair_id']
+    unique_pairs = np.unique(pair_ids)
+    if len(unique_pairs) >= valid_pair_min_count:
+        valid_pair_count = min(max(1, int(round(len(unique_pairs) * valid_ratio))), len(unique_pairs) - 1)
+        valid_pairs = rng.choice(unique_pairs, valid_pair_count, replace=False)
+        b_valid = np.isin(pair_ids, valid_pairs)
+        print('hold out %d image pairs for validation: %s' % (valid_pair_count, str(sorted(valid_pairs.tolist()))))
+    else:
+        print('warning, only %d image pairs (< %d), hold out random pixels for validation' %
+              (len(unique_pairs), valid_pair_min_count))
+        b_valid = np.zeros(len(pair_ids), dtype=bool)
+        b_valid[rng.choice(len(pair_ids), int(len(pair_ids) * valid_ratio), replace=False)] = True
+
+    train_dataset = copy.copy(dataset)
+    train_dataset.pixel_index_pairs = dataset.pixel_index_pairs[~b_valid]
+    valid_dataset = copy.copy(dataset)
+    valid_dataset.pixel_index_pairs = dataset.pixel_index_pairs[b_valid]
+    return train_dataset, valid_dataset
+
 class two_images_pixel_pair(torch.utils.data.Dataset):
 
-    def __init__(self, root, changedet_pair_txt, win_size, train=True, transform=None, target_transform=None, predict_pair_id=0, subset_boundary=None):
+    def __init__(self, root, changedet_pair_txt, win_size, train=True, transform=None, target_transform=None, predict_pair_id=0, subset_boundary=None,
+                 npy_cache_dir=None):
         # super().__init__() need this one?
         '''
         read images for change detections
@@ -117,6 +268,8 @@ class two_images_pixel_pair(torch.utils.data.Dataset):
         :param target_transform: apply tarnsform to target images
         :param predict_pair_id: the pair for predicting (prediction only load data from one pair)
         :param subset_boundary: the subset boundary of image  (xoff,yoff ,xsize, ysize) in pixel coordinate
+        :param npy_cache_dir: a folder for caching training images as .npy files, which are opened as memory maps
+                              (shared between workers) instead of reading to memory. None for not using the cache
         '''
 
         self.root = os.path.expanduser(root)
@@ -124,20 +277,24 @@ class two_images_pixel_pair(torch.utils.data.Dataset):
         self.imgs_path_txt = changedet_pair_txt
         self.win_size = win_size
         self.img_pair_list = []         # image list, each one is (old_image, new_image, label_path)
-        self.img_array_pair_list = []   # image array list, each one is (old_image array, new_image array, label array)
+        # image array list, each one is (old_image array, new_image array, label array),
+        # the old and new image are padded (see _pad_image), so the patch of each pixel is a view of them
+        self.img_array_pair_list = []
+        self.img_window_view_list = []  # sliding window views of the padded old and new images
+        self.npy_cache_dir = npy_cache_dir
+        self.img_npy_pair_list = []     # .npy cache of the padded old and new images, opened lazily by _get_image_arrays
         self.target_transform = target_transform
         self.train = train  # True for training and validation (also need label), False for prediction
 
         # for each element: [old_image, new_image, label_path (if available)]
         self.img_pair_list = read_img_pair_paths(self.root, changedet_pair_txt)
 
-        self.pixel_index_pairs = []  # each one: (image_id, row_index, col_index, label) # label for change or no-change
+        # each one: (pair_id, row, col, label) # label for change or no-change, see pixel_index_dtype
+        self.pixel_index_pairs = np.empty(0, dtype=pixel_index_dtype)
 
 
         if self.train:
-            no_change_idx = []
-            change_idx = []
-            idx = 0
+            pixel_index_list = []
             # get pairs for training
             for pair_id, image_pair in enumerate(self.img_pair_list):
 
@@ -146,38 +303,37 @@ class two_images_pixel_pair(torch.utils.data.Dataset):
                 new_img_path = image_pair[1]  # a new image
                 change_map_path = image_pair[2] # label
 
-                # read image to memory
-                old_image_array = read_image_to_array(old_img_path)
-                new_image_array = read_image_to_array(new_img_path)
                 change_map_array = read_image_to_array(change_map_path)
-
                 if change_map_array.shape[0] != 1:
                     raise ValueError('error, the label should only have one band')
-                self.img_array_pair_list.append([old_image_array, new_image_array, change_map_array])
+
+                if self.npy_cache_dir is not None:
+                    # only the cache files, open them as memory maps when it's needed
+                    pad_width = get_pad_width(self.win_size)
+                    self.img_npy_pair_list.append([get_image_npy_cache(old_img_path, self.npy_cache_dir, pad_width),
+                                                   get_image_npy_cache(new_img_path, self.npy_cache_dir, pad_width)])
+                    self.img_array_pair_list.append(None)
+                else:
+                    # read image to memory
+                    old_image_array = read_image_to_array(old_img_path)
+                    new_image_array = read_image_to_array(new_img_path)
+                    self.img_array_pair_list.append([self._pad_image(old_image_array), self._pad_image(new_image_array), change_map_array])
 
                 label_data = np.squeeze(change_map_array)
                 height, width = label_data.shape # nband, height, width
-                for row in range(height):
-                    for col in range(width):
-                        self.pixel_index_pairs.append((pair_id, row, col, label_data[row, col]))
-                        if label_data[row, col] == label_change_value:       # change pixel 2
-                            change_idx.append(idx)
-                        elif label_data[row, col] == label_no_change_value:     # no-change pixel 1
-                            no_change_idx.append(idx)
-                        else:
-                            raise ValueError('Error: unknown label: %d at row: %d, col: %d'
-                                             %(label_data[row, col],row, col))
-                        idx += 1
+                pixel_index_list.append(get_pixel_index_array(pair_id, height, width, label_data))
+
+            self.pixel_index_pairs = np.concatenate(pixel_index_list)
+            change_idx = np.nonzero(self.pixel_index_pairs['label'] == label_change_value)[0]
+            no_change_idx = np.nonzero(self.pixel_index_pairs['label'] == label_no_change_value)[0]
 
             #remove some no-change pixel because the number of them is too large
             # or maybe we manually selected some non-change areas
             if len(no_change_idx) > len(change_idx)*3:
                 keep_count = len(change_idx)*3
-                keep_idx_list = random.sample(range(len(no_change_idx)), keep_count)
-
-                keep_pixel_index_pairs = [self.pixel_index_pairs[item] for item in change_idx]
-                keep_pixel_index_pairs.extend([self.pixel_index_pairs[no_change_idx[keep_idx]] for keep_idx in keep_idx_list ])
-                self.pixel_index_pairs = keep_pixel_index_pairs
+                rng = np.random.RandomState(sample_random_seed)
+                keep_no_change_idx = rng.choice(no_change_idx, keep_count, replace=False)
+                self.pixel_index_pairs = self.pixel_index_pairs[np.concatenate([change_idx, keep_no_change_idx])]
 
             pass
         else:
@@ -185,31 +341,13 @@ class two_images_pixel_pair(torch.utils.data.Dataset):
             image_pair = self.img_pair_list[predict_pair_id]
             # for pair_id, image_pair in enumerate(self.img_pair_list):
 
-            check_image_pairs(image_pair)
-            old_img_path = image_pair[0]  # an old image
-            new_img_path = image_pair[1]  # a new image
-
             # read image to memory
-            if subset_boundary is None:
-                # read the entire image
-                old_image_array = read_image_to_array(old_img_path)
-                new_image_array = read_image_to_array(new_img_path)
-            else:
-                # only read the subset
-                old_subset = patchclass(old_img_path,subset_boundary)
-                new_subset = patchclass(new_img_path,subset_boundary)
-
-                old_image_array = read_patch(old_subset)
-                new_image_array = read_patch(new_subset)
-
-            self.img_array_pair_list.append([old_image_array, new_image_array])
+            old_image_array, new_image_array = read_image_pair_for_prediction(image_pair, subset_boundary)
 
             ncount, height, width = old_image_array.shape
-            for row in range(height):
-                for col in range(width):
-                    # print(ncount, height, width, row, col)  # output for testing
-                    # for a large image, the following will use a lot of computer memory.
-                    self.pixel_index_pairs.append((predict_pair_id, row, col, None))   #label_data[row, col]
+            self.img_array_pair_list.append([self._pad_image(old_image_array), self._pad_image(new_image_array)])
+
+            self.pixel_index_pairs = get_pixel_index_array(predict_pair_id, height, width)
 
             pass
 
@@ -237,52 +375,99 @@ class two_images_pixel_pair(torch.utils.data.Dataset):
 
         return new_image
 
-    def _get_sub_image(self,row_index, col_index, image_array):
+    def _pad_image(self, image_array):
         '''
-        get a subset from a image array, padding if the window be is out of the image
-        :param row_index:
-        :param col_index:
-        :param image_array:
-        :return:
+        pad an image with zeros, then the patch of the pixel at (row, col) is [:, row:row+win_height, col:col+win_width],
+        the same as cropping [row - win_height/2, row + win_height/2) and padding zeros outside the image
+        :param image_array: image array, shape (nband, height, width)
+        :return: the padded image array
         '''
-        nband, height,width = image_array.shape
-
-        # set window (row_start, row_stop), (col_start, col_stop)
-        row_start = row_index - int(self.win_size[0] / 2)  # win_size: (height, width)
-        row_stop = row_index + int(self.win_size[0] / 2)
-        col_start = col_index - int(self.win_size[1] / 2)
-        col_stop = col_index + int(self.win_size[1] / 2)
-
-        # adjust the boundary
-        adj_row_start = 0 if row_start < 0 else row_start
-        adj_row_stop = height if row_stop > height else row_stop
-        adj_col_start = 0 if col_start < 0 else  col_start
-        adj_col_stop = width if col_stop > width else col_stop
+        return np.pad(image_array, get_pad_width(self.win_size), mode='constant', constant_values=0)
 
-        if (adj_row_stop - adj_row_start ) != self.win_size[0] or (adj_col_stop - adj_col_start ) != self.win_size[1]:
-            new_image = np.zeros((image_array.shape[0], self.win_size[0], self.win_size[1]),
-                                 dtype=image_array.dtype)
-
-            new_image[:, (adj_row_start-row_start):(self.win_size[0]-(row_stop-adj_row_stop)),
-            (adj_col_start - col_start):(self.win_size[1] - (col_stop - adj_col_stop))] = \
-                image_array[:, adj_row_start:adj_row_stop, adj_col_start: adj_col_stop]
+    def _get_image_arrays(self, array_idx):
+        '''
+        get the padded old and new image array, open the .npy cache as memory maps if they have not been opened
+        :param array_idx: the index in self.img_array_pair_list
+        :return: old image array, new image array
+        '''
+        if self.img_array_pair_list[array_idx] is None:
+            self.img_array_pair_list[array_idx] = [np.load(npy_path, mmap_mode='r') for npy_path in self.img_npy_pair_list[array_idx]]
+        return self.img_array_pair_list[array_idx][:2]
+
+    def __getstate__(self):
+        # when sending to workers, only pass the paths of the .npy cache, each worker opens the memory maps by itself
+        state = self.__dict__.copy()
+        if self.npy_cache_dir is not None:
+            state['img_array_pair_list'] = [None] * len(self.img_array_pair_list)
+            state['img_window_view_list'] = []
+        return state
+
+    def _get_window_views(self, array_idx):
+        '''
+        get the sliding window views of the padded old and new image, shape (nband, height, width, win_height, win_width)
+        :param array_idx: the index in self.img_array_pair_list
+        :return: old_view, new_view
+        '''
+        while len(self.img_window_view_list) <= array_idx:
+            self.img_window_view_list.append(None)
+        if self.img_window_view_list[array_idx] is None:
+            self.img_window_view_list[array_idx] = [sliding_window_view(img_array, self.win_size, axis=(1, 2))
+                                                    for img_array in self._get_image_arrays(array_idx)]
+        return self.img_window_view_list[array_idx]
+
+    def __getitems__(self, indices):
+        '''
+        get a batch of samples, the patches are gathered from sliding window views by fancy indexing
+        :param indices: a list of sample indices
+        :return: the same as __getitem__, but each element contains the entire batch
+        '''
+        pixel_index = self.pixel_index_pairs[np.asarray(indices, dtype=np.int64)]
+        pair_ids = pixel_index['pair_id']
+        rows = pixel_index['row']
+        cols = pixel_index['col']
+
+        old_img_array, new_img_array = self._get_image_arrays(0)
+        patch_shape = (len(pixel_index), old_img_array.shape[0], self.win_size[0], self.win_size[1])
+        old_img_patches = np.empty(patch_shape, dtype=old_img_array.dtype)
+        new_img_patches = np.empty(patch_shape, dtype=new_img_array.dtype)
+
+        for pair_id in np.unique(pair_ids):
+            sel = np.nonzero(pair_ids == pair_id)[0]
+            # for prediction, only read one pair
+            old_view, new_view = self._get_window_views(int(pair_id) if self.train else 0)
+            # view[:, rows, cols] has a shape of (nband, count, win_height, win_width)
+            old_img_patches[sel] = np.moveaxis(old_view[:, rows[sel], cols[sel]], 0, 1)
+            new_img_patches[sel] = np.moveaxis(new_view[:, rows[sel], cols[sel]], 0, 1)
+
+        # the transform should support a batch of images (count, nband, height, width)
+        if self.transform is not None:
+            old_img_patches = self.transform(old_img_patches)
+            new_img_patches = self.transform(new_img_patches)
 
+        if self.train:
+            # shape: (count, 1), the same as collating torch.tensor([0]) or torch.tensor([1])
+            label_target = torch.from_numpy(pixel_index['label'].astype(np.int64)).view(-1, 1)
+            return [old_img_patches, new_img_patches], label_target
         else:
-            new_image = image_array[:, row_start:row_stop, col_start: col_stop]
-        # print(new_image.shape)
-        # if new_image.shape != (3,28,28):
-        #     raise ValueError('error, it is not (3,28,28)')
-        return new_image
+            return [old_img_patches, new_img_patches], [torch.from_numpy(pair_ids.astype(np.int64)),
+                                                        torch.from_numpy(rows.astype(np.int64)),
+                                                        torch.from_numpy(cols.astype(np.int64))]
 
     def __getitem__(self, index):
 
+        # a batch of indices from get_batch_data_loader
+        if isinstance(index, (list, np.ndarray)):
+            return self.__getitems__(index)
+
         # read old and new image, as well as label
-        pair_id, row_index, col_index, label = self.pixel_index_pairs[index]
+        pixel_index = self.pixel_index_pairs[index]
+        pair_id, row_index, col_index, label = int(pixel_index['pair_id']), int(pixel_index['row']), \
+                                               int(pixel_index['col']), int(pixel_index['label'])
         # old_img_path, new_img_path = self.img_pair_list[pair_id][:2]
         if self.train:
-            old_img_array, new_img_array = self.img_array_pair_list[pair_id][:2]
+            old_img_array, new_img_array = self._get_image_arrays(pair_id)
         else:
-            old_img_array, new_img_array = self.img_array_pair_list[0][:2]      # for prediction, only read one pair
+            old_img_array, new_img_array = self._get_image_arrays(0)      # for prediction, only read one pair
 
         # # read old image
         # with rasterio.open(old_img_path) as old_src:       # every pixel, read image from disk is very time consuming
@@ -304,8 +489,9 @@ class two_images_pixel_pair(torch.utils.data.Dataset):
         #     new_img_patch = self._crop_padding(new_img_patch)
 
         # ncount, height, width = old_img_array.shape
-        old_img_patch = self._get_sub_image(row_index,col_index,old_img_array)
-        new_img_patch = self._get_sub_image(row_index,col_index,new_img_array)
+        # the images have been padded, so the window always inside the image
+        old_img_patch = old_img_array[:, row_index:row_index + self.win_size[0], col_index:col_index + self.win_size[1]]
+        new_img_patch = new_img_array[:, row_index:row_index + self.win_size[0], col_index:col_index + self.win_size[1]]
 
         if self.transform is not None:
             old_img_patch = self.transform(old_img_patch)
@@ -18,7 +18,6 @@ sys.path.insert(0, os.path.expanduser('~/codes/PycharmProjects/DeeplabforRS'))
 import basic_src.basic as basic
 import basic_src.io_function as io_function
 import vector_gpd
-from vector_features import shape_opeation
 import parameters
 import basic_src.RSImage as RSImage
 from basic_src.RSImage import RSImageclass
@@ -26,8 +25,11 @@ from basic_src.RSImage import RSImageclass
 import basic_src.map_projection as map_projection
 import pandas as pd
 
-import random
 import math
+from collections import OrderedDict
+import hashlib
+import pickle
+import sqlite3
 
 # local modules
 # sys.path.insert(0, '../../lib/')
@@ -39,7 +41,9 @@ import math
 import numpy as np
 
 import multiprocessing
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 import shapely
 from shapely.geometry import LineString
@@ -47,12 +51,22 @@ from shapely.geometry import Point
 from shapely.geometry import Polygon
 
 import rasterio
+from rasterio.windows import Window
+from scipy.spatial import Voronoi
+from scipy.spatial import cKDTree
 
 import geopandas as gpd
 
 # parameter for sampling medial circles
 global_sep_distance = 20
 global_topSize_count = 3
+# increase it if the calculation in cal_one_expand_area_dis changes, then old results in the cache will not be used
+global_retreat_dis_cache_version = 1
+
+# the DEM opened once in each process (set by init_dem_src or get_dem_src), and its block cache
+global_dem_path = None
+global_dem_src = None
+global_dem_block_cache = None
 
 class get_medial_axis_class(object):
     def __init__(self):
@@ -73,70 +87,127 @@ def get_projection_proj4(geo_file):
     import basic_src.map_projection as map_projection
     return map_projection.get_raster_or_vector_srs_info_proj4(geo_file)
 
-def get_medial_axis_of_one_polygon(vertices, h=0.5, proc_id=0):
+def densify_ring_points(ring_xy, spacing):
     '''
-    due to the unstable codes (error of interrupted by signal 11: SIGSEGV)
-    we try to call the script to get result
-    :param vertices:
-    :param h:
-    :return:
+    sample points along a closed ring, the distance between two neighbouring points is not larger than spacing
+    :param ring_xy: numpy array of the ring vertices (n by 2), the last one can be the same as the first one
+    :param spacing: the maximum distance between two points
+    :return: numpy array (m by 2) of points, not closed
+    '''
+    if np.allclose(ring_xy[0], ring_xy[-1]):
+        ring_xy = ring_xy[:-1]
+    seg_start = ring_xy
+    seg_vec = np.roll(ring_xy, -1, axis=0) - ring_xy
+    seg_len = np.hypot(seg_vec[:, 0], seg_vec[:, 1])
+    pts_count = np.maximum(np.ceil(seg_len / spacing).astype(np.int64), 1)
+    seg_idx = np.repeat(np.arange(len(seg_start)), pts_count)
+    first_pts = np.repeat(np.cumsum(pts_count) - pts_count, pts_count)
+    t_ratio = (np.arange(len(seg_idx)) - first_pts) / pts_count[seg_idx]
+    return seg_start[seg_idx] + seg_vec[seg_idx] * t_ratio[:, None]
+
+def points_in_polygon(polygon, points_xy):
+    '''
+    check if points are inside a polygon
+    :param polygon: a shapely polygon
+    :param points_xy: numpy array (n by 2)
+    :return: a boolean numpy array
+    '''
+    if len(points_xy) < 1:
+        return np.zeros(0, dtype=bool)
+    if shapely.__version__ >= '2':
+        return shapely.contains_xy(polygon, points_xy[:, 0], points_xy[:, 1])
+    from shapely.prepared import prep
+    prepared_polygon = prep(polygon)
+    return np.array([prepared_polygon.contains(Point(x, y)) for x, y in points_xy], dtype=bool)
+
+def compute_medial_axis_voronoi(vertices, h):
+    '''
+    approximate the medial axis of a polygon using the Voronoi diagram of points densely sampled on its boundary.
+    The Voronoi edges inside the polygon (exclude the ones between two neighbouring boundary points) form the medial axis,
+    the distance from a Voronoi vertex to its generating points is the radius of the inscribed circle.
+    :param vertices: numpy array of polygon vertices (n by 2)
+    :param h: the distance for sampling points on the boundary
+    :return: medial_axis (m by 2 by 2 numpy array), radiuses (m by 2 numpy array)
+    '''
+    polygon = Polygon(vertices)
+    if polygon.is_valid is False:
+        polygon = polygon.buffer(0)
+    boundary_pts = densify_ring_points(np.asarray(vertices, dtype=np.float64)[:, :2], h)
+    pts_count = len(boundary_pts)
+
+    vor = Voronoi(boundary_pts)
+    ridge_vertices = np.array(vor.ridge_vertices, dtype=np.int64)
+    ridge_points = vor.ridge_points
+
+    # remove infinite ridges and ridges between two neighbouring points on the boundary
+    pts_diff = np.abs(ridge_points[:, 0] - ridge_points[:, 1])
+    b_keep = np.all(ridge_vertices >= 0, axis=1) & (pts_diff != 1) & (pts_diff != pts_count - 1)
+    ridge_vertices = ridge_vertices[b_keep]
+    ridge_points = ridge_points[b_keep]
+
+    # only keep the ridges inside the polygon
+    b_inside = points_in_polygon(polygon, vor.vertices)
+    b_keep = b_inside[ridge_vertices[:, 0]] & b_inside[ridge_vertices[:, 1]]
+    ridge_vertices = ridge_vertices[b_keep]
+    ridge_points = ridge_points[b_keep]
+
+    medial_axis = vor.vertices[ridge_vertices]      # m by 2 (two ends) by 2 (x, y)
+    generator = boundary_pts[ridge_points[:, 0]]
+    radiuses = np.stack([np.hypot(*(medial_axis[:, 0, :] - generator).T),
+                         np.hypot(*(medial_axis[:, 1, :] - generator).T)], axis=1)
+    return medial_axis, radiuses
+
+def get_inscribed_circle_at_representative_point(vertices, h):
+    '''
+    an approximation of medial axis without the Voronoi diagram: the inscribed circle at the representative point
+    :param vertices: numpy array of polygon vertices (n by 2)
+    :param h: the h value, only for output
+    :return: medial_axis (a list of ((x1,y1),(x2,y2)) ), radiuses (a list of (r1,r2)), h
+    '''
+    polygon = Polygon(vertices)
+    center = polygon.representative_point()
+    r = polygon.exterior.distance(center)
+    return [((center.x, center.y), (center.x, center.y))], [(r, r)], h
+
+def get_medial_axis_of_one_polygon(vertices, h=0.5, proc_id=0, max_pts_count=20000, b_voronoi=True):
+    '''
+    get the medial axis of a polygon and the radiuses of medial circles, computed in the current process without
+    temporary files. Qhull (in scipy Voronoi) may crash the process (SIGSEGV), so it should be called in a worker
+    process (see cal_one_expand_area_dis_isolated).
+    If failed, try again with a smaller h; if still failed, use the largest inscribed circle from the representative point.
+    :param vertices: numpy array of polygon vertices (n by 2)
+    :param h: the distance for sampling points on the boundary, in the unit of the projection
+    :param proc_id: process id, only for output message
+    :param max_pts_count: the maximum number of sampled points, increase h if it has too many points
+    :param b_voronoi: if False, don't compute the Voronoi diagram, use the inscribed circle at the representative point
+    :return: medial_axis (a list of ((x1,y1),(x2,y2)) ), radiuses (a list of (r1,r2)), h
     '''
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if b_voronoi is False:
+        return get_inscribed_circle_at_representative_point(vertices, h)
+    perimeter = np.sum(np.hypot(*np.diff(vertices[:, :2], axis=0).T))
+    if perimeter / h > max_pts_count:
+        h = perimeter / max_pts_count
+
+    medial_axis, radiuses = None, None
+    for try_h in [h, h / 2.0, h / 4.0]:
+        try:
+            medial_axis, radiuses = compute_medial_axis_voronoi(vertices, try_h)
+        except Exception as e:  # e.g., QhullError for degenerate polygons
+            basic.outputlogMessage('process %d: failed to get medial axis with h = %f: %s' % (proc_id, try_h, str(e)))
+            continue
+        if len(medial_axis) > 0:
+            h = try_h
+            break
+        basic.outputlogMessage('process %d: no medial axis found with h = %f, reduce h and try again' % (proc_id, try_h))
+
+    if medial_axis is None or len(medial_axis) < 1:
+        basic.outputlogMessage('Warning, failed to get medial axis, use the largest inscribed circle at the representative point')
+        return get_inscribed_circle_at_representative_point(vertices, h)
 
-    # save the vertices to files
-    tmp_polygon_txt = 'out_polygon_vertices_%d.txt'%proc_id
-    tmp_medial_axis_txt = 'save_medial_axis_radius_%d.txt'%proc_id
-    if os.path.isfile(tmp_polygon_txt):
-        io_function.delete_file_or_dir(tmp_polygon_txt)
-    if os.path.isfile(tmp_medial_axis_txt):
-        io_function.delete_file_or_dir(tmp_medial_axis_txt)
-
-    ## not necessary, previously, the error is due to its small area, not the triangular shape
-    # new_vertices = []
-    # if len(vertices) < 5: # for a triangle
-    #     basic.outputlogMessage('Warning, insert some points for a triangle')
-    #     # manually added some points
-    #     for idx in range(len(vertices)-1):
-    #         new_vertices.append(vertices[idx])
-    #         a_new_point = ((vertices[idx][0] + vertices[idx+1][0])/2.0,
-    #                        (vertices[idx][1] + vertices[idx + 1][1]) / 2.0)
-    #         new_vertices.append(a_new_point)
-    #     new_vertices.append(vertices[-1])
-    #     vertices = np.array(new_vertices)
-
-    res = np.savetxt(tmp_polygon_txt,vertices)
-    # print(res)
-
-    # call the script to
-    script = os.path.expanduser('~/codes/PycharmProjects/yghlc_Computational-Geometry/HW/project/code/medial_axis_outRadius.py')
-
-    # if script crash, then try again, with a differnt h value
-    while os.path.isfile(tmp_medial_axis_txt) is False:
-        args_list = [script, tmp_polygon_txt, str(h)]
-        if basic.exec_command_args_list_one_file(args_list, tmp_medial_axis_txt) is False:
-            basic.outputlogMessage('failed to get medial axis and radius, change h value, then try again')
-            h = h - 0.05
-        if os.path.isfile(tmp_medial_axis_txt) and os.path.getsize(tmp_medial_axis_txt) < 1:
-            print('fileSize:',os.path.getsize(tmp_medial_axis_txt))
-            io_function.delete_file_or_dir(tmp_medial_axis_txt)
-            h = h - 0.05
-        if h < 0.1:
-            h = random.uniform(0.01, 0.1)
-
-    if os.path.isfile(tmp_medial_axis_txt) is False:
-        raise ValueError('error, failed to get medial axis and radius')
-
-    # read result from file
-    medial_axis_radiuses = np.loadtxt(tmp_medial_axis_txt)
-    if medial_axis_radiuses.ndim == 1:      # if the result has only one row, change to 2 dimision
-        medial_axis_radiuses = medial_axis_radiuses.reshape(1,medial_axis_radiuses.shape[0])
-    print('medial_axis_radiuses.shape:',medial_axis_radiuses.shape)
-    medial_axis = []
-    radiuses = []
-    for row in medial_axis_radiuses:
-        x1, y1, x2, y2, r1, r2 = row
-        medial_axis.append(((x1,y1),(x2,y2)))
-        radiuses.append((r1,r2))
-    return medial_axis, radiuses, h
+    medial_axis_list = [((x1, y1), (x2, y2)) for (x1, y1), (x2, y2) in medial_axis.tolist()]
+    radiuses_list = [(r1, r2) for r1, r2 in radiuses.tolist()]
+    return medial_axis_list, radiuses_list, h
 
 def meidal_circles_segment(exp_polygon,a_medial_axis, radius,dem_src, dem_res):
 
@@ -150,7 +221,6 @@ def meidal_circles_segment(exp_polygon,a_medial_axis, radius,dem_src, dem_res):
 
     # for (x0,y0), r in zip(a_medial_axis, radius):
 
-    center_point = Point(x0,y0)
     # half length of the line segment for calculating elevation difference
     line_half_len_for_dem = r + dem_res # + 10 #max(dem_res/2.0, 10)
 
@@ -187,13 +257,169 @@ def meidal_circles_segment(exp_polygon,a_medial_axis, radius,dem_src, dem_res):
     max_diff_eles = max(diff_ele_list)
     max_d_ele_index_list =  [i for i, x in enumerate(diff_ele_list) if x == max_diff_eles]
 
+    median_line_length, angle_median = median_line_across_medial_circle(exp_polygon, x0, y0,
+                                                                        [angle_list[index] for index in max_d_ele_index_list])
+
+    return median_line_length, angle_median, x0, y0
+
+class dem_block_cache(object):
+    '''
+    a small LRU cache of decoded blocks (the first band) of a DEM, keyed by the block window, limited by max_bytes
+    (in each process). Neighbouring expanding polygons read the same blocks, for compressed DEMs (e.g., LZW),
+    this avoids decoding them again
+    '''
+    def __init__(self, dem_src, max_bytes=64*1024*1024, min_block_size=256, max_block_size=512):
+        self.dem_src = dem_src
+        self.max_bytes = max_bytes
+        self.cached_bytes = 0
+        # cache blocks are aligned to the internal blocks (tiles) of the DEM, and at least min_block_size.
+        # For strips (the width of the DEM) or large tiles, cap the size to max_block_size
+        native_h, native_w = dem_src.block_shapes[0]
+        self.block_h = native_h * int(math.ceil(min_block_size / float(native_h)))
+        self.block_w = native_w * int(math.ceil(min_block_size / float(native_w)))
+        if self.block_h > max_block_size:
+            self.block_h = max_block_size
+        if self.block_w > max_block_size:
+            self.block_w = max_block_size
+        self.block_h = min(self.block_h, dem_src.height)
+        self.block_w = min(self.block_w, dem_src.width)
+        self.blocks = OrderedDict()
+
+    def get_block(self, b_row, b_col):
+        key = (b_row, b_col)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        row_off = b_row * self.block_h
+        col_off = b_col * self.block_w
+        height = min(self.block_h, self.dem_src.height - row_off)
+        width = min(self.block_w, self.dem_src.width - col_off)
+        block = self.dem_src.read(1, window=Window(col_off, row_off, width, height))
+        self.blocks[key] = block
+        self.cached_bytes += block.nbytes
+        # remove the least recently used ones, but keep the one just read
+        while self.cached_bytes > self.max_bytes and len(self.blocks) > 1:
+            _, old_block = self.blocks.popitem(last=False)
+            self.cached_bytes -= old_block.nbytes
+        return block
+
+    def read(self, row_off, col_off, height, width):
+        '''
+        read a window (inside the DEM) from cached blocks
+        :return: 2D numpy array
+        '''
+        window_data = np.empty((height, width), dtype=self.dem_src.dtypes[0])
+        for b_row in range(row_off // self.block_h, (row_off + height - 1) // self.block_h + 1):
+            for b_col in range(col_off // self.block_w, (col_off + width - 1) // self.block_w + 1):
+                block = self.get_block(b_row, b_col)
+                b_row_off, b_col_off = b_row * self.block_h, b_col * self.block_w
+                r0, r1 = max(row_off, b_row_off), min(row_off + height, b_row_off + block.shape[0])
+                c0, c1 = max(col_off, b_col_off), min(col_off + width, b_col_off + block.shape[1])
+                window_data[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = \
+                    block[r0 - b_row_off:r1 - b_row_off, c0 - b_col_off:c1 - b_col_off]
+        return window_data
+
+def init_dem_src(dem_path):
+    '''
+    initializer of the process pool, open the DEM once in each worker
+    :param dem_path: the path of the DEM, can be None
+    :return:
+    '''
+    if dem_path is not None:
+        get_dem_src(dem_path)
+
+def get_dem_src(dem_path):
+    '''
+    get the DEM opened in this process, open it (and create a block cache) if it is not opened yet
+    :param dem_path: the path of the DEM
+    :return: dem rasterio object
+    '''
+    global global_dem_path, global_dem_src, global_dem_block_cache
+    if global_dem_src is None or global_dem_path != dem_path:
+        if global_dem_src is not None:
+            global_dem_src.close()
+        global_dem_src = rasterio.open(dem_path)
+        global_dem_path = dem_path
+        global_dem_block_cache = dem_block_cache(global_dem_src)
+    return global_dem_src
+
+def read_dem_window(dem_src, row_off, col_off, height, width):
+    '''
+    read a window of the first band of DEM, from the block cache if this DEM was opened by get_dem_src
+    :param dem_src: dem rasterio object
+    :return: 2D numpy array
+    '''
+    if global_dem_block_cache is not None and global_dem_block_cache.dem_src is dem_src:
+        return global_dem_block_cache.read(int(row_off), int(col_off), int(height), int(width))
+    return dem_src.read(1, window=Window(col_off, row_off, width, height))
+
+def meidal_circles_segment_vectorized(exp_polygon,a_medial_axis, radius,dem_src, dem_res):
+    '''
+    the same as meidal_circles_segment, but compute all the line ends with numpy, read one DEM window covering
+    the circle once, then get elevation of all the ends by array indexing (instead of 360 calls of dem_src.sample)
+    '''
+    (x1, y1), (x2, y2) = a_medial_axis  # (x1, y1) and (x2, y2) are close to each other
+    r1, r2 = radius
+
+    # use the one with larger radius
+    x0, y0, r = x1, y1, r1
+    if r2 > r1:
+        x0, y0, r = x2, y2, r2
+
+    # half length of the line segment for calculating elevation difference
+    line_half_len_for_dem = r + dem_res
+
+    angle_list = np.arange(0, 180)
+    rad = np.radians(angle_list)
+    dx = line_half_len_for_dem*np.cos(rad)
+    dy = line_half_len_for_dem*np.sin(rad)
+    xs_ys = np.stack([np.concatenate([x0 + dx, x0 - dx]), np.concatenate([y0 + dy, y0 - dy])])
+
+    # pixel location of the line ends (the same as dem_src.sample)
+    rows, cols = rasterio.transform.rowcol(dem_src.transform, xs_ys[0], xs_ys[1])
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    b_inside = (rows >= 0) & (rows < dem_src.height) & (cols >= 0) & (cols < dem_src.width)
+
+    # the ends outside the DEM get nodata (or 0), as dem_src.sample does
+    fill_value = dem_src.nodata if dem_src.nodata is not None else 0
+    elevations = np.full(len(rows), fill_value, dtype=dem_src.dtypes[0])
+    if np.any(b_inside):
+        row_off, col_off = rows[b_inside].min(), cols[b_inside].min()
+        dem_window = read_dem_window(dem_src, row_off, col_off,
+                                     rows[b_inside].max() - row_off + 1, cols[b_inside].max() - col_off + 1)
+        elevations[b_inside] = dem_window[rows[b_inside] - row_off, cols[b_inside] - col_off]
+
+    ele_s, ele_e = elevations[:len(angle_list)], elevations[len(angle_list):]
+    diff_ele = np.abs(ele_s - ele_e)
+
+    # find the maximum elevation difference (could have multiple values)
+    max_d_ele_index_list = np.where(diff_ele == diff_ele.max())[0]
+
+    median_line_length, angle_median = median_line_across_medial_circle(exp_polygon, x0, y0,
+                                                                        [int(angle_list[index]) for index in max_d_ele_index_list])
+
+    return median_line_length, angle_median, x0, y0
+
+def median_line_across_medial_circle(exp_polygon, x0, y0, angles):
+    '''
+    construct lines through (x0, y0) at the given angles, intersect them with the expanding polygon,
+    and output the median length
+    :param exp_polygon: the expanding polygon
+    :param x0: x of the circle center
+    :param y0: y of the circle center
+    :param angles: a list of angles (degree, relative to x axis)
+    :return: median_line_length, angle_median
+    '''
+    center_point = Point(x0,y0)
+
     box = exp_polygon.bounds
     line_half_len_for_interset = max(abs(box[2]-box[0]), abs(box[3] - box[1]))/2.0
     inter_line_length = []
     inter_line_angle = []
-    for index in max_d_ele_index_list:
+    for angle in angles:
         # construct a line
-        rad = math.radians(angle_list[index])
+        rad = math.radians(angle)
         dx = line_half_len_for_interset * math.cos(rad)
         dy = line_half_len_for_interset * math.sin(rad)
 
@@ -224,13 +450,13 @@ def meidal_circles_segment(exp_polygon,a_medial_axis, radius,dem_src, dem_res):
             raise ValueError('type is %s, need to be upgraded'%inter_lines.geom_type)
 
         inter_line_length.append(inter_lines.length)
-        inter_line_angle.append(angle_list[index])
+        inter_line_angle.append(angle)
 
     # # output the maximum length and angle
     # max_line_length = max(inter_line_length)
-    # angle_max = angle_list[max_d_ele_index_list[inter_line_length.index(max_line_length)]]
+    # angle_max = inter_line_angle[inter_line_length.index(max_line_length)]
     #
-    # return max_line_length, angle_max, x0, y0
+    # return max_line_length, angle_max
 
     # output the median value
     inter_line_length_np = np.array(inter_line_length)
@@ -238,7 +464,7 @@ def meidal_circles_segment(exp_polygon,a_medial_axis, radius,dem_src, dem_res):
     median_line_length = np.sort(inter_line_length_np)[len(inter_line_length_np)//2]
     angle_median = inter_line_angle[inter_line_length.index(median_line_length)]
 
-    return median_line_length, angle_median, x0, y0
+    return median_line_length, angle_median
 
 def meidal_circles_segment_across_center(exp_polygon,a_medial_axis, radius, old_polygon_center):
 
@@ -343,13 +569,14 @@ def cal_distance_along_polygon_center(exp_polygon,medial_axis, radiuses,old_poly
     return max_value, angle_at_max, center_at_max
 
 
-def cal_distance_along_slope(exp_polygon,medial_axis, radiuses, dem_src):
+def cal_distance_along_slope(exp_polygon,medial_axis, radiuses, dem_src, b_dem_window=True):
     '''
     calculate distance at the direction of maximum elevation difference (not on the slope)
     :param exp_polygon:
     :param medial_axis:
     :param radiuses:
     :param dem_src: dem rasterio object
+    :param b_dem_window: if True, read one DEM window for each medial circle, otherwise, sample DEM point by point
     :return:
     '''
 
@@ -364,8 +591,9 @@ def cal_distance_along_slope(exp_polygon,medial_axis, radiuses, dem_src):
     angle_list = []
     center_point_list = []
 
+    segment_func = meidal_circles_segment_vectorized if b_dem_window else meidal_circles_segment
     for n_index in top_n_index:
-        dis_at_max_dem_diff, angle, x0, y0 = meidal_circles_segment(exp_polygon,medial_axis[n_index], radiuses[n_index],dem_src, dem_resolution)
+        dis_at_max_dem_diff, angle, x0, y0 = segment_func(exp_polygon,medial_axis[n_index], radiuses[n_index],dem_src, dem_resolution)
         dis_at_max_dem_diff_list.append(dis_at_max_dem_diff)
         angle_list.append(angle)
         center_point_list.append((x0,y0))
@@ -388,7 +616,73 @@ def cal_distance_along_expanding_line(idx, exp_polygon,expanding_line):
 
     pass
 
-def cal_one_expand_area_dis(idx,exp_polygon, total_polygon_count, dem_path, old_poly, expand_line):
+def get_retreat_dis_cache_key(exp_polygon, dem_info, old_poly, expand_line):
+    '''
+    get the key of a expanding polygon in the retreat distance cache
+    :param exp_polygon: a expanding polygon
+    :param dem_info: a string of the DEM path and its modified time, None if no DEM
+    :param old_poly: the old polygon of the expanding polygon, could be None
+    :param expand_line: the expanding line, could be None
+    :return: a hex string
+    '''
+    sha = hashlib.sha1()
+    sha.update(exp_polygon.wkb)
+    for geom in [old_poly, expand_line]:
+        sha.update(b'|')
+        if geom is not None:
+            sha.update(geom.wkb)
+    sha.update(('|%s|%s|%d|%d' % (global_retreat_dis_cache_version, dem_info,
+                                  global_sep_distance, global_topSize_count)).encode('utf-8'))
+    return sha.hexdigest()
+
+class retreat_dis_cache(object):
+    '''
+    a SQLite file storing results of cal_one_expand_area_dis, so rerunning with other thresholds can skip
+    polygons that have been calculated
+    '''
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS retreat_dis (key TEXT PRIMARY KEY, result BLOB)')
+        self.conn.commit()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get_results(self, keys, chunk_size=500):
+        '''
+        get cached results
+        :param keys: a list of keys
+        :param chunk_size: the number of keys in one query (SQLite limits the number of variables)
+        :return: a dict: key -> result (without the polygon index)
+        '''
+        results = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), chunk_size):
+            sub_keys = keys[start:start + chunk_size]
+            sql = 'SELECT key, result FROM retreat_dis WHERE key IN (%s)' % ','.join(['?'] * len(sub_keys))
+            for key, blob in self.conn.execute(sql, sub_keys):
+                results[key] = pickle.loads(blob)
+        return results
+
+    def save_results(self, key_results):
+        '''
+        save results in one transaction
+        :param key_results: a list of (key, result), result is without the polygon index
+        :return:
+        '''
+        if len(key_results) < 1:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO retreat_dis (key, result) VALUES (?, ?)',
+                                  [(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)) for key, result in key_results])
+
+def cal_one_expand_area_dis(idx,exp_polygon, total_polygon_count, dem_path, old_poly, expand_line, b_voronoi=True):
 
     basic.outputlogMessage(
         'Calculating expanding distance of %dth (0 index) polygon, total: %d' % (idx, total_polygon_count))
@@ -424,8 +718,9 @@ def cal_one_expand_area_dis(idx,exp_polygon, total_polygon_count, dem_path, old_
         vertices = [(x, y) for (x, y) in zip(x_list, y_list)]
         vertices = np.array(vertices)
 
-        # interrupted by signal 11: SIGSEGV or segmentation fault may be avoid if change the h value
-        medial_axis, radiuses, h_value = get_medial_axis_of_one_polygon(vertices, h=h_value, proc_id=proc_id)
+        # computed in this process (the Voronoi diagram of boundary points), no temporary files
+        medial_axis, radiuses, h_value = get_medial_axis_of_one_polygon(vertices, h=h_value, proc_id=proc_id,
+                                                                        b_voronoi=b_voronoi)
 
         # # for test, ONLY draw the figures of medial circles (remove this when run in parallel)
         # save_path = "medial_axis_circle_for_%d_polygon.jpg"%idx
@@ -433,7 +728,7 @@ def cal_one_expand_area_dis(idx,exp_polygon, total_polygon_count, dem_path, old_
         # plot_polygon_medial_axis_circle_line(vertices,medial_axis, radiuses,top_n_index,line_obj=None, save_path=save_path)
 
         if dem_path is not None:
-            dem_src = rasterio.open(dem_path)
+            dem_src = get_dem_src(dem_path)     # opened once in each process
             dis_slope, dis_direction, l_c_point = cal_distance_along_slope(exp_polygon, medial_axis, radiuses, dem_src=dem_src)
             dis_line_p_x0, dis_line_p_y0 = l_c_point
 
@@ -485,7 +780,85 @@ def cal_one_expand_area_dis(idx,exp_polygon, total_polygon_count, dem_path, old_
            dis_along_center, dis_c_angle, dis_c_line_x0, dis_c_line_y0, dis_e_line, select_medial_axis
 
 
-def cal_expand_area_distance(expand_shp, expand_line=None, dem_path = None, old_shp= None, proc_num=None,save_medial_axis=False):
+def run_expand_area_dis_pool(parameters_list, process_num, dem_path):
+    '''
+    run cal_one_expand_area_dis in a new process pool
+    :param parameters_list: a list of parameters of cal_one_expand_area_dis
+    :param process_num: the number of processes
+    :param dem_path: the DEM, opened once in each process
+    :return: a dict of results (index in parameters_list: result), the ones missing are unfinished when the pool is
+            broken (a worker process crashed)
+    '''
+    results = {}
+    b_broken = False
+    with ProcessPoolExecutor(max_workers=process_num, initializer=init_dem_src, initargs=(dem_path,)) as executor:
+        future_to_idx = {executor.submit(cal_one_expand_area_dis, *parameters): p_idx
+                         for p_idx, parameters in enumerate(parameters_list)}
+        for future in as_completed(future_to_idx):
+            try:
+                results[future_to_idx[future]] = future.result()
+            except BrokenProcessPool:
+                b_broken = True
+    if b_broken:
+        basic.outputlogMessage('Warning, a worker process crashed, %d out of %d polygons are unfinished'
+                               % (len(parameters_list) - len(results), len(parameters_list)))
+    return results
+
+def cal_one_expand_area_dis_isolated(parameters_list, process_num, dem_path):
+    '''
+    run cal_one_expand_area_dis in worker processes (even process_num is 1), then a crash of Qhull (SIGSEGV) when
+    computing the Voronoi diagram only kills a worker, not this process. After a crash, the unfinished polygons are run
+    in order by one worker until it crashes again, that polygon uses the inscribed circle at the representative point
+    instead of the medial axis, then the remaining ones are run in parallel again.
+    :param parameters_list: a list of parameters of cal_one_expand_area_dis
+    :param process_num: the number of processes
+    :param dem_path: the DEM, opened once in each process
+    :return: results (the same order as parameters_list), a list of idx (polygon index) of skipped polygons
+    '''
+    results = [None]*len(parameters_list)
+    skip_idx_list = []
+    todo_list = list(range(len(parameters_list)))
+    worker_num = process_num
+    while len(todo_list) > 0:
+        round_results = run_expand_area_dis_pool([parameters_list[p_idx] for p_idx in todo_list], worker_num, dem_path)
+        for r_idx, res in round_results.items():
+            results[todo_list[r_idx]] = res
+        todo_list = [p_idx for p_idx in todo_list if results[p_idx] is None]
+        if len(todo_list) < 1:
+            break
+        if worker_num == 1:
+            # one worker runs the polygons in order, so the first unfinished one crashed the process
+            p_idx = todo_list.pop(0)
+            idx = parameters_list[p_idx][0]
+            basic.outputlogMessage('Warning, computing the medial axis of %dth polygon crashed the process, '
+                                   'use the inscribed circle at the representative point' % idx)
+            results[p_idx] = cal_one_expand_area_dis(*parameters_list[p_idx], b_voronoi=False)
+            skip_idx_list.append(idx)
+            worker_num = process_num
+        else:
+            # find out the polygon crashing the process
+            worker_num = 1
+
+    return results, skip_idx_list
+
+def add_fields_to_shapefile(shp_path, field_values):
+    '''
+    add (or overwrite) multiple fields of a shapefile, read and write the shapefile only once
+    :param shp_path: the shapefile
+    :param field_values: dict, field name: a list of values (the same order as the records)
+    :return: True if successful
+    '''
+    shapefile = gpd.read_file(shp_path)
+    attributes = pd.DataFrame(field_values, index=shapefile.index)
+    for field_name in attributes.columns:
+        if len(field_name) > 10:
+            raise ValueError('the field name: %s is longer than 10 characters (the limit of shapefile)' % field_name)
+        shapefile[field_name] = attributes[field_name]
+    shapefile.to_file(shp_path, driver='ESRI Shapefile')
+    return True
+
+def cal_expand_area_distance(expand_shp, expand_line=None, dem_path = None, old_shp= None, proc_num=None,save_medial_axis=False,
+                             cache_db=None):
     '''
     calculate the distance of expanding areas along the upslope direction.
     The distance will be saved to expand_shp, backup it if necessary
@@ -493,6 +866,7 @@ def cal_expand_area_distance(expand_shp, expand_line=None, dem_path = None, old_
     :param expand_line: lines indicating the expanding the direction
     :param dem_path: the dem path for calculating the slope distance along slope
     :param old_shp: the shape file storing the old polygons
+    :param cache_db: a SQLite file for caching results of each polygon, None for not using the cache
     :return: True if successful
     '''
 
@@ -560,20 +934,45 @@ def cal_expand_area_distance(expand_shp, expand_line=None, dem_path = None, old_
     else:
         num_cores = proc_num
 
-    if proc_num > 1:
+    # skip the polygons whose results are in the cache
+    dis_cache = None
+    cached_results = {}
+    cache_keys = [None]*len(expand_polygons)
+    if cache_db is not None:
+        dem_info = None if dem_path is None else '%s|%f' % (os.path.abspath(dem_path), os.path.getmtime(dem_path))
+        cache_keys = [get_retreat_dis_cache_key(exp_polygon, dem_info, old_poly_list[idx], e_line_list[idx])
+                      for idx, exp_polygon in enumerate(expand_polygons)]
+        dis_cache = retreat_dis_cache(cache_db)
+        cached_results = dis_cache.get_results(cache_keys)
+    todo_idx_list = [idx for idx in range(len(expand_polygons)) if cache_keys[idx] not in cached_results]
+    if dis_cache is not None:
+        basic.outputlogMessage('get results of %d polygons from %s, need to calculate %d polygons'
+                               % (len(expand_polygons) - len(todo_idx_list), cache_db, len(todo_idx_list)))
+
+    # computed in worker processes (also if num_cores is 1), a crash of Qhull does not stop this process
+    new_results = []
+    skip_idx_list = []
+    if len(todo_idx_list) > 0:
         print('number of thread %d' % num_cores)
-        theadPool = Pool(num_cores)  # multi processes
         parameters_list = [
-            (idx, exp_polygon, len(expand_polygons), dem_path, old_poly_list[idx], e_line_list[idx]) for idx, exp_polygon in enumerate(expand_polygons)]
-        results = theadPool.starmap(cal_one_expand_area_dis, parameters_list)  # need python3
-    else:
-        ##################################################################
-        # another way to test non-parallel version
-        results = []
-        for idx, exp_polygon in enumerate(expand_polygons):
-            res = cal_one_expand_area_dis(idx, exp_polygon, len(expand_polygons), dem_path, old_poly_list[idx],e_line_list[idx])
-            results.append(res)
-        ####################################################################
+            (idx, expand_polygons[idx], len(expand_polygons), dem_path, old_poly_list[idx], e_line_list[idx]) for idx in todo_idx_list]
+        new_results, skip_idx_list = cal_one_expand_area_dis_isolated(parameters_list, num_cores, dem_path)
+        if len(skip_idx_list) > 0:
+            basic.outputlogMessage('Warning, the medial axis of %d polygons (index: %s) are approximated by the '
+                                   'inscribed circle at the representative point' % (len(skip_idx_list), str(skip_idx_list)))
+
+    if dis_cache is not None:
+        # don't save the approximated ones, then they will be calculated again next time
+        dis_cache.save_results([(cache_keys[res[0]], res[1:]) for res in new_results if res[0] not in skip_idx_list])
+        dis_cache.close()
+
+    # put cached and new results back in the order of expand_polygons
+    results = [None]*len(expand_polygons)
+    for res in new_results:
+        results[res[0]] = res
+    for idx in range(len(expand_polygons)):
+        if results[idx] is None:
+            results[idx] = (idx,) + tuple(cached_results[cache_keys[idx]])
 
     for result in results:
         # it still has the same order as expand_polygons
@@ -682,35 +1081,31 @@ def cal_expand_area_distance(expand_shp, expand_line=None, dem_path = None, old_
     # #
     #     # break
 
-    # save the distance to shapefile
-    shp_obj = shape_opeation()
-    shp_obj.add_one_field_records_to_shapefile(expand_shp, poly_min_Ws, 'e_min_dis')
-    shp_obj.add_one_field_records_to_shapefile(expand_shp, poly_max_Ws, 'e_max_dis')
-    shp_obj.add_one_field_records_to_shapefile(expand_shp, poly_mean_Ws, 'e_mean_dis')
-    shp_obj.add_one_field_records_to_shapefile(expand_shp, poly_median_Ws, 'e_medi_dis')
-    shp_obj.add_one_field_records_to_shapefile(expand_shp, h_value_list, 'e_medi_h')
+    # save the distance to shapefile, collect all the fields, then write the shapefile once
+    save_fields = {'e_min_dis': poly_min_Ws,
+                   'e_max_dis': poly_max_Ws,
+                   'e_mean_dis': poly_mean_Ws,
+                   'e_medi_dis': poly_median_Ws,
+                   'e_medi_h': h_value_list}
 
     if dem_path is not None:
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_slope_list, 'e_dis_slop')
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_angle_list, 'e_dis_angl')
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_l_x0_list, 'e_dis_p_x0')
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_l_y0_list, 'e_dis_p_y0')
-
-        diff_e_poly_max_slope_list = [  dis - max_Ws  for dis, max_Ws  in zip(dis_slope_list, poly_max_Ws)]
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, diff_e_poly_max_slope_list, 'diff_dis')
+        save_fields['e_dis_slop'] = dis_slope_list
+        save_fields['e_dis_angl'] = dis_angle_list
+        save_fields['e_dis_p_x0'] = dis_l_x0_list
+        save_fields['e_dis_p_y0'] = dis_l_y0_list
+        save_fields['diff_dis'] = [  dis - max_Ws  for dis, max_Ws  in zip(dis_slope_list, poly_max_Ws)]
 
     if old_shp is not None:
-
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_center_list, 'c_dis_cen')
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_c_angle_list, 'c_dis_angl')
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_c_x0_list, 'c_dis_p_x0')
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_c_y0_list, 'c_dis_p_y0')
-
-        diff_e_poly_cent_dis_list = [  dis - max_Ws  for dis, max_Ws  in zip(dis_center_list, poly_max_Ws)]
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, diff_e_poly_cent_dis_list, 'c_diff_dis')
+        save_fields['c_dis_cen'] = dis_center_list
+        save_fields['c_dis_angl'] = dis_c_angle_list
+        save_fields['c_dis_p_x0'] = dis_c_x0_list
+        save_fields['c_dis_p_y0'] = dis_c_y0_list
+        save_fields['c_diff_dis'] = [  dis - max_Ws  for dis, max_Ws  in zip(dis_center_list, poly_max_Ws)]
 
     if expand_line is not None:
-        shp_obj.add_one_field_records_to_shapefile(expand_shp, dis_e_line_list, 'e_dis_line')
+        save_fields['e_dis_line'] = dis_e_line_list
+
+    add_fields_to_shapefile(expand_shp, save_fields)
 
     basic.outputlogMessage('Save expanding distance of all the polygons to %s'%expand_shp)
 
@@ -731,48 +1126,42 @@ def cal_expand_area_distance(expand_shp, expand_line=None, dem_path = None, old_
 
     return True
 
-def getDis(point1, point2):
-    dx = point1[0]-point2[0]
-    dy = point1[1]-point2[1]
-    return math.sqrt(dx*dx + dy*dy)
-
 def find_top_n_medial_circle_with_sampling(medial_axis, radiuses, sep_distance=10, n=10):
     '''
     find N largest medial circle, each of them separately at least sep_distance
-    :param medial_axis:
-    :param radiuses:
+    :param medial_axis: a list of line segment: ((x1, y1), (x2, y2))
+    :param radiuses: a list of (r1, r2)
     :param sep_distance:
     :param n:
-    :return:
+    :return: a list of index (in medial_axis)
     '''
-
-    # sort, from max to min
-    radiuses_sorted = sorted(radiuses, reverse=True)    # each has two r, very close
-    found_medial_axis = []
+    segments = np.asarray(medial_axis, dtype=np.float64).reshape(-1, 2, 2)
+    radiuses_np = np.asarray(radiuses, dtype=np.float64).reshape(-1, 2)
+
+    # sort, from max to min (by r1, then r2), the same radiuses keep their original order
+    sorted_index = np.lexsort((-radiuses_np[:, 1], -radiuses_np[:, 0]))
+
+    # a KD-tree of all the segment ends, end 2*i and 2*i+1 belong to the i-th segment
+    ends = segments.reshape(-1, 2)
+    tree = cKDTree(ends)
+    # query_ball_point return points with distance <= r, we need distance < sep_distance
+    query_r = np.nextafter(sep_distance, 0)
+    b_found = np.zeros(len(segments), dtype=bool)
     found_index = []
-    for sort_r in radiuses_sorted:
-
-        index = radiuses.index(sort_r)  # the index in medial_axis
-        (x1, y1), (x2, y2) = medial_axis[index]
-        # check distance
-        b_well_separated = True
-        for m_axis in found_medial_axis:
-            (x1_f, y1_f), (x2_f, y2_f) = m_axis
-            if getDis((x1, y1),(x1_f, y1_f)) < sep_distance or getDis((x1, y1),(x2_f, y2_f)) < sep_distance or \
-                getDis((x2, y2), (x1_f, y1_f)) < sep_distance or getDis((x2, y2), (x2_f, y2_f)) < sep_distance:
-                b_well_separated = False
-
-        if b_well_separated:
-            found_medial_axis.append([(x1, y1), (x2, y2)])
-            found_index.append(index)
-
-        if len(found_medial_axis) >= n:
-            break
+    for index in sorted_index:
+        # check distance to ends of the segments have been found
+        near_ends = tree.query_ball_point(ends[2*index:2*index + 2], r=query_r)
+        near_segments = np.array([item // 2 for ends_list in near_ends for item in ends_list], dtype=np.int64)
+        if np.any(b_found[near_segments]):
+            continue
 
-    # top_N_radius =radiuses_sorted[:100]
-    # top_n_index = [ radiuses.index(item) for item in top_N_radius ]
+        b_found[index] = True
+        found_index.append(int(index))
 
-    print('intend to find %d, in fact, found %d' % (n, len(found_medial_axis)))
+        if len(found_index) >= n:
+            break
+
+    print('intend to find %d, in fact, found %d' % (n, len(found_index)))
 
     return found_index
 
@@ -855,7 +1244,8 @@ def main(options, args):
     # plot_polygon_medial_axis_circle_line(polygon,medial_axis,radiuses,top_n_index)
 
 
-    cal_expand_area_distance(args[0],expand_line=options.expanding_line_shp, dem_path=options.dem_path, old_shp=options.old_polygon_shp)
+    cal_expand_area_distance(args[0],expand_line=options.expanding_line_shp, dem_path=options.dem_path, old_shp=options.old_polygon_shp,
+                             cache_db=options.cache_db)
 
     pass
 
@@ -882,6 +1272,10 @@ if __name__ == "__main__":
                       action="store", dest="expanding_line_shp",
                       help="the path to the shapefile storing lines indicating the ")
 
+    parser.add_option("-c", "--cache_db",
+                      action="store", dest="cache_db",
+                      help="a SQLite file for caching the retreat distance of each polygon, reused in next runs")
+
 
     (options, args) = parser.parse_args()
     if len(sys.argv) < 2:
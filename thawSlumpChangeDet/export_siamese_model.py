@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# Filename: export_siamese_model
+"""
+introduction: export the trained siamese neural network to TorchScript, with optional INT8 quantization,
+and report the accuracy and speed compared with the FP32 model
+"""
+
+import sys,os
+from optparse import OptionParser
+import time
+
+import torch
+from torch import nn
+
+from siamese_thawslump_cd import Net
+from siamese_thawslump_cd import get_transform
+from siamese_thawslump_cd import load_trained_model
+import dataTools.img_pairs as img_pairs
+from dataTools.img_pairs import two_images_pixel_pair
+
+def set_quantized_engine():
+    # fbgemm for x86 CPUs, qnnpack for ARM CPUs
+    for engine in ['fbgemm', 'qnnpack']:
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise ValueError('error, no supported quantized engine in this PyTorch')
+
+def get_example_data(data_loader):
+    data, _ = next(iter(data_loader))
+    return [data[0], data[1]]
+
+def quantize_model(model, quant_mode, calib_loader=None, calib_batch_count=20):
+    '''
+    quantize a FP32 model to INT8 (CPU only)
+    :param model: a trained Net (FP32)
+    :param quant_mode: 'dynamic': quantize the weights of linear1 and linear2, activations are quantized on the fly;
+                       'static': quantize the convolutions and linear layers, calibrated by calib_loader
+    :param calib_loader: the data loader of training pairs for calibration (static only)
+    :param calib_batch_count: the number of batches for calibration
+    :return: the quantized model
+    '''
+    set_quantized_engine()
+    if quant_mode == 'dynamic':
+        return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    elif quant_mode == 'static':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        if calib_loader is None:
+            raise ValueError('error, static quantization needs data for calibration')
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        prepared_model = prepare_fx(model, qconfig_mapping, example_inputs=(get_example_data(calib_loader),))
+        with torch.no_grad():
+            for batch_idx, (data, _) in enumerate(calib_loader):
+                if batch_idx >= calib_batch_count:
+                    break
+                prepared_model(data[:2])
+        return convert_fx(prepared_model)
+    else:
+        raise ValueError('error, unknown quantization mode: %s' % quant_mode)
+
+def export_torchscript(model, example_data, save_path):
+    '''
+    trace the model and save it as TorchScript, which can be loaded by siamese_thawslump_cd.py for prediction
+    :param model: a model (FP32 or quantized)
+    :param example_data: [old image patches, new image patches]
+    :param save_path: the save path
+    :return: the TorchScript model
+    '''
+    with torch.no_grad():
+        script_model = torch.jit.trace(model, (example_data,))
+    torch.jit.save(script_model, save_path)
+    print('Save TorchScript model to %s' % save_path)
+
+    # smoke check: load the saved one, it should give the same output as the model before tracing
+    check_exported_model(model, torch.jit.load(save_path, map_location='cpu'), example_data)
+    return script_model
+
+def check_exported_model(model, script_model, example_data, atol=1e-4):
+    '''
+    check that the exported model gives the same output (and the same predicted labels) as the eager model on one batch
+    :param model: the model before tracing (FP32 or quantized)
+    :param script_model: the TorchScript model
+    :param example_data: [old image patches, new image patches]
+    :param atol: the tolerance of the output
+    :return: True if the same, otherwise, raise an error
+    '''
+    with torch.no_grad():
+        eager_output = model(example_data)
+        script_output = script_model(example_data)
+    if eager_output.shape != script_output.shape:
+        raise ValueError('error, the output shape of the exported model %s is different from the model %s'
+                         % (str(tuple(script_output.shape)), str(tuple(eager_output.shape))))
+    max_diff = torch.max(torch.abs(eager_output - script_output)).item()
+    same_label = torch.equal(torch.argmax(eager_output, dim=1), torch.argmax(script_output, dim=1))
+    print('check the exported model on one batch: max difference of outputs: %g, the same labels: %s'
+          % (max_diff, str(same_label)))
+    if max_diff > atol or same_label is False:
+        raise ValueError('error, the exported model gives different outputs from the model before exporting')
+    return True
+
+def evaluate_accuracy_speed(model, device, data_loader, max_batch_count=None, warmup_batch_count=3):
+    '''
+    evaluate the accuracy and the inference speed of a model
+    :param model: a model
+    :param device:
+    :param data_loader: the data loader of held-out pairs (with labels)
+    :param max_batch_count: the maximum number of batches, None for all
+    :param warmup_batch_count: the number of untimed runs before timing (memory allocation, optimization of TorchScript)
+    :return: accuracy (%), samples per second
+    '''
+    accurate_labels = 0
+    all_labels = 0
+    compute_time = 0.0
+    with torch.no_grad():
+        data, _ = next(iter(data_loader))
+        data = [data[0].to(device), data[1].to(device)]
+        for _ in range(warmup_batch_count):
+            model(data)
+
+        for batch_idx, (data, target) in enumerate(data_loader):
+            if max_batch_count is not None and batch_idx >= max_batch_count:
+                break
+            data = [data[0].to(device), data[1].to(device)]
+            label_target = target.type(torch.LongTensor).view(-1)
+
+            t0 = time.time()
+            output_target = model(data)
+            compute_time += time.time() - t0
+
+            accurate_labels += torch.sum(torch.argmax(output_target, dim=1).cpu() == label_target).item()
+            all_labels += len(label_target)
+
+    if all_labels < 1:
+        raise ValueError('error, no samples for evaluation')
+    return 100.0 * accurate_labels / all_labels, all_labels / compute_time
+
+def main(options, args):
+    # quantized models only run on CPU
+    device = torch.device('cpu')
+    trans = get_transform()
+
+    data_root = os.path.expanduser(args[0])
+    train_pairs_txt = os.path.expanduser(args[1])
+    batch_size = options.batch_size
+
+    if options.load_model_path is None:
+        raise ValueError('error, the trained model (-m) is not set')
+    model = load_trained_model(options.load_model_path, device)
+    if isinstance(model, Net) is False:
+        raise ValueError('error, %s is not a state dict of Net' % options.load_model_path)
+
+    # training pairs, for example data and calibration
+    train_loader = img_pairs.get_batch_data_loader(
+        two_images_pixel_pair(data_root, train_pairs_txt, (28, 28), train=True, transform=trans),
+        batch_size, options.num_workers, shuffle=True)
+    example_data = get_example_data(train_loader)
+
+    if options.quant_mode == 'none':
+        export_model = model
+    else:
+        export_model = quantize_model(model, options.quant_mode, calib_loader=train_loader,
+                                      calib_batch_count=options.calib_batch_count)
+
+    if options.save_path is not None:
+        save_path = options.save_path
+    else:
+        save_path = os.path.splitext(options.load_model_path)[0] + '_%s_script.pt' % options.quant_mode
+    script_model = export_torchscript(export_model, example_data, save_path)
+
+    # compare with the FP32 model on held-out pairs
+    if options.validation_pairs_txt is not None:
+        valid_loader = img_pairs.get_batch_data_loader(
+            two_images_pixel_pair(data_root, os.path.expanduser(options.validation_pairs_txt), (28, 28), train=True,
+                                  transform=trans), batch_size, options.num_workers, shuffle=False)
+        report_lines = ['model, accuracy (%), samples per second']
+        for name, eval_model in [('FP32', model), ('%s TorchScript' % options.quant_mode, script_model)]:
+            accuracy, speed = evaluate_accuracy_speed(eval_model, device, valid_loader,
+                                                      max_batch_count=options.eval_batch_count,
+                                                      warmup_batch_count=options.warmup_batch_count)
+            report_lines.append('%s, %.3f, %.1f' % (name, accuracy, speed))
+        print('\n'.join(report_lines))
+        report_path = os.path.splitext(save_path)[0] + '_report.txt'
+        with open(report_path, 'w') as f_obj:
+            f_obj.writelines([line + '\n' for line in report_lines])
+        print('Save accuracy and speed report to %s' % report_path)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] root_dir train_images_paths_txt"
+    parser = OptionParser(usage=usage)
+    parser.description = 'Introduction: export the trained siamese neural network to TorchScript, ' \
+                         'with optional INT8 quantization '
+
+    parser.add_option('-m', '--load_model_path',
+                      action="store", dest='load_model_path',
+                      help='the trained model (state dict) for exporting')
+
+    parser.add_option('-o', '--save_path',
+                      action="store", dest='save_path',
+                      help='the path for saving the TorchScript model')
+
+    parser.add_option('-q', '--quant_mode', default='none',
+                      action="store", dest='quant_mode',
+                      help='quantization mode: none, dynamic (linear layers), or static (convolutions and linear layers)')
+
+    parser.add_option('-v', '--validation_pairs_txt',
+                      action="store", dest='validation_pairs_txt',
+                      help='a txt file of held-out image pairs (with labels), for the accuracy and speed report')
+
+    parser.add_option("-b", "--batch_size", type=int, default=256,
+                      action="store", dest="batch_size",
+                      help="the batch size")
+
+    parser.add_option('-n', '--num_workers', type=int, default=4,
+                      action="store", dest='num_workers',
+                      help='the number of workers for loading images')
+
+    parser.add_option('-c', '--calib_batch_count', type=int, default=20,
+                      action="store", dest='calib_batch_count',
+                      help='the number of batches of training pairs for calibrating static quantization')
+
+    parser.add_option('-e', '--eval_batch_count', type=int, default=100,
+                      action="store", dest='eval_batch_count',
+                      help='the number of batches of held-out pairs for evaluation')
+
+    parser.add_option('-w', '--warmup_batch_count', type=int, default=3,
+                      action="store", dest='warmup_batch_count',
+                      help='the number of untimed batches for warming up each model before timing')
+
+    (options, args) = parser.parse_args()
+    if len(sys.argv) < 2 or len(args) < 2:
+        parser.print_help()
+        sys.exit(2)
+
+    main(options, args)
@@ -20,20 +20,268 @@ import parameters
 
 import vector_gpd
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 # from geopandas import GeoSeries
 
+import shapely
+from shapely.strtree import STRtree
+
+import math
+from multiprocessing import Pool
+
 # for polygon comparison
 
+def build_polygons_strtree(polygons):
+    '''
+    build a STRtree (spatial index) for a list of polygons
+    :param polygons: a list of shapely polygons
+    :return: the tree, and a dict mapping id of a polygon to its index (only needed for shapely < 2.0)
+    '''
+    tree = STRtree(polygons)
+    geom_id_to_idx = {id(poly): idx for idx, poly in enumerate(polygons)}
+    return tree, geom_id_to_idx
+
+def get_intersect_polygon_index(a_polygon, polygons, tree, geom_id_to_idx):
+    '''
+    find polygons (in polygons) intersecting a_polygon, query the bounding box candidates in tree first,
+    then check them using the "intersects" predicate
+    :param a_polygon: a shapely polygon
+    :param polygons: a list of shapely polygons, the ones used to build the tree
+    :param tree: the STRtree of polygons
+    :param geom_id_to_idx: dict mapping id of polygons to its index
+    :return: a list of index (in ascending order), the same order as checking them one by one
+    '''
+    if shapely.__version__ >= '2':
+        candidate_idx = [int(item) for item in tree.query(a_polygon)]   # shapely 2.0 return the index
+    else:
+        candidate_idx = [geom_id_to_idx[id(item)] for item in tree.query(a_polygon)]
+    candidate_idx.sort()
+    return [idx for idx in candidate_idx if polygons[idx].intersects(a_polygon)]
+
+def get_expand_shrink_polygons_vectorized(old_polygons, new_polygons, old_shp_path, new_shp_path, b_log=True):
+    '''
+    the same as get_expand_shrink_polygons, but gather all the (old, new) pairs, then calculate intersects,
+    difference and is_empty in bulk using the vectorized functions in shapely 2.0
+    :param old_polygons: a list of old polygons
+    :param new_polygons: a list of new polygons
+    :param old_shp_path: the path of the old polygons (for the file name)
+    :param new_shp_path: the path of the new polygons (for the file name)
+    :param b_log: if False, don't output the messages (the index of polygons is local for a tile)
+    :return: expanding_df, shrinking_df
+    '''
+    old_file = os.path.basename(old_shp_path)
+    new_file = os.path.basename(new_shp_path)
+
+    old_array = np.empty(len(old_polygons), dtype=object)
+    old_array[:] = old_polygons
+    new_array = np.empty(len(new_polygons), dtype=object)
+    new_array[:] = new_polygons
+
+    # all intersecting pairs, query return [[index of new], [index of old]], sort by new index then old index,
+    # that is the same order as checking them one by one
+    tree = STRtree(old_array)
+    pair_new_idx, pair_old_idx = tree.query(new_array, predicate='intersects')
+    pair_order = np.lexsort((pair_old_idx, pair_new_idx))
+    pair_new_idx = pair_new_idx[pair_order].astype(np.int64)
+    pair_old_idx = pair_old_idx[pair_order].astype(np.int64)
+
+    # the number of old polygons that a new polygon intersect
+    inters_num = np.bincount(pair_new_idx, minlength=len(new_array))
+    if b_log:
+        for idx_new in np.where(inters_num > 1)[0]:
+            basic.outputlogMessage('Warning, the %dth new polygon intersect %d old polygons' % (idx_new, inters_num[idx_new]))
+
+    polygon_expand = shapely.difference(new_array[pair_new_idx], old_array[pair_old_idx])
+    polygon_shrink = shapely.difference(old_array[pair_old_idx], new_array[pair_new_idx])
+    b_expand = ~shapely.is_empty(polygon_expand)
+    b_shrink = ~shapely.is_empty(polygon_shrink)
+    if b_log:
+        basic.outputlogMessage('info, %d pairs of old and new polygons in %s and %s, %d without expanding, %d without shrinking, '
+                               '%d are identical' % (len(pair_new_idx), old_file, new_file, np.sum(~b_expand),
+                                                     np.sum(~b_shrink), np.sum(~b_expand & ~b_shrink)))
+
+    # expanding (1) and new (2) polygons, in the order of new polygons
+    new_only_idx = np.where(inters_num == 0)[0].astype(np.int64)
+    e_new_idx = np.concatenate([pair_new_idx[b_expand], new_only_idx])
+    e_order = np.argsort(e_new_idx, kind='stable')
+    expanding_df = pd.DataFrame({'ChangeType': np.concatenate([np.full(np.sum(b_expand), 1, dtype=np.int64),
+                                                               np.full(len(new_only_idx), 2, dtype=np.int64)])[e_order],
+                                 'old_file': [old_file] * len(e_new_idx),
+                                 'old_index': np.concatenate([pair_old_idx[b_expand],
+                                                              np.full(len(new_only_idx), -9999, dtype=np.int64)])[e_order],
+                                 'new_file': [new_file] * len(e_new_idx),
+                                 'new_index': e_new_idx[e_order],
+                                 'inters_num': np.concatenate([inters_num[pair_new_idx[b_expand]],
+                                                               np.zeros(len(new_only_idx), dtype=np.int64)])[e_order],
+                                 'PolygonExpand': np.concatenate([polygon_expand[b_expand], new_array[new_only_idx]])[e_order]
+                                })
 
-def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink_save_path):
+    # shrinking (3) polygons, then absent (4) polygons in the old set of polygons
+    absent_idx = np.setdiff1d(np.arange(len(old_array)), pair_old_idx).astype(np.int64)
+    if len(absent_idx) < 1 and b_log:
+        basic.outputlogMessage('No polygon disappear in %s' % old_shp_path)
+    s_count = np.sum(b_shrink) + len(absent_idx)
+    shrinking_df = pd.DataFrame({'ChangeType': np.concatenate([np.full(np.sum(b_shrink), 3, dtype=np.int64),
+                                                               np.full(len(absent_idx), 4, dtype=np.int64)]),
+                                 'old_file': [old_file] * s_count,
+                                 'old_index': np.concatenate([pair_old_idx[b_shrink], absent_idx]),
+                                 'new_file': [new_file] * s_count,
+                                 'new_index': np.concatenate([pair_new_idx[b_shrink],
+                                                              np.full(len(absent_idx), -9999, dtype=np.int64)]),
+                                 'inters_num': np.concatenate([inters_num[pair_new_idx[b_shrink]],
+                                                               np.zeros(len(absent_idx), dtype=np.int64)]),
+                                 'PolygonShrink': np.concatenate([polygon_shrink[b_shrink], old_array[absent_idx]])
+                                })
+
+    return expanding_df, shrinking_df
+
+def partition_polygons_to_tiles(old_polygons, new_polygons, tile_count):
+    '''
+    partition the study area into tile_count by tile_count tiles. Each new polygon is assigned to the tile containing the
+    center of its bounding box, so a polygon crossing tile borders only belongs to one tile. The halo of a tile is
+    the extent of its new polygons (can extend to neighbouring tiles), all old polygons overlapping the halo are
+    added to the tile, therefore, no intersecting (old, new) pair will be missed.
+    :param old_polygons: a list of old polygons
+    :param new_polygons: a list of new polygons
+    :param tile_count: the tile count in x and y direction
+    :return: a list of (old_idx_array, new_idx_array), only for tiles containing new polygons, in the order of tile id
+    '''
+    old_bounds = np.array([poly.bounds for poly in old_polygons]).reshape(-1, 4)
+    new_bounds = np.array([poly.bounds for poly in new_polygons]).reshape(-1, 4)
+    all_bounds = np.concatenate([old_bounds, new_bounds])
+    xmin, ymin = all_bounds[:, 0].min(), all_bounds[:, 1].min()
+    xmax, ymax = all_bounds[:, 2].max(), all_bounds[:, 3].max()
+    tile_width = max((xmax - xmin) / tile_count, 1e-6)
+    tile_height = max((ymax - ymin) / tile_count, 1e-6)
+
+    center_x = (new_bounds[:, 0] + new_bounds[:, 2]) / 2.0
+    center_y = (new_bounds[:, 1] + new_bounds[:, 3]) / 2.0
+    tile_col = np.clip(((center_x - xmin) / tile_width).astype(np.int64), 0, tile_count - 1)
+    tile_row = np.clip(((center_y - ymin) / tile_height).astype(np.int64), 0, tile_count - 1)
+    tile_id = tile_row * tile_count + tile_col
+
+    tiles = []
+    for t_id in np.unique(tile_id):
+        new_idx = np.where(tile_id == t_id)[0]
+        h_xmin, h_ymin = new_bounds[new_idx, 0].min(), new_bounds[new_idx, 1].min()
+        h_xmax, h_ymax = new_bounds[new_idx, 2].max(), new_bounds[new_idx, 3].max()
+        old_idx = np.where((old_bounds[:, 0] <= h_xmax) & (old_bounds[:, 2] >= h_xmin) &
+                           (old_bounds[:, 1] <= h_ymax) & (old_bounds[:, 3] >= h_ymin))[0]
+        tiles.append((old_idx, new_idx))
+    return tiles
+
+def get_expand_shrink_polygons_one_tile(tile_idx, old_idx, new_idx, old_polygons, new_polygons, old_shp_path, new_shp_path,
+                                        b_use_index=True, b_vectorized=False):
+    '''
+    compare old and new polygons in a tile, then change old_index and new_index to the index in the entire shapefile
+    :param tile_idx: tile index
+    :param old_idx: the index (in the entire shapefile) of old polygons in this tile
+    :param new_idx: the index (in the entire shapefile) of new polygons in this tile
+    :param old_polygons: old polygons in this tile
+    :param new_polygons: new polygons in this tile
+    :return: tile_idx, expanding_df, shrinking_df, old_idx_intersect (index of old polygons intersecting new polygons)
+    '''
+    # messages are output after merging all tiles, using the index in the entire shapefile
+    old_idx = np.asarray(old_idx, dtype=np.int64)
+    new_idx = np.asarray(new_idx, dtype=np.int64)
+    if b_vectorized and len(old_polygons) > 0:
+        expanding_df, shrinking_df = get_expand_shrink_polygons_vectorized(old_polygons, new_polygons, old_shp_path,
+                                                                           new_shp_path, b_log=False)
+    else:
+        expanding_df, shrinking_df = get_expand_shrink_polygons(old_polygons, new_polygons, old_shp_path, new_shp_path,
+                                                                b_use_index=(b_use_index and len(old_polygons) > 0),
+                                                                b_log=False)
+
+    # the absent polygons in this tile may intersect new polygons in other tiles, decide them after merging
+    # (the columns are object dtype if the data frame is empty)
+    absent_local = shrinking_df.loc[shrinking_df['ChangeType'] == 4, 'old_index'].values.astype(np.int64)
+    old_idx_intersect = np.setdiff1d(old_idx, old_idx[absent_local])
+    shrinking_df = shrinking_df[shrinking_df['ChangeType'] != 4].copy()
+
+    for df in [expanding_df, shrinking_df]:
+        # only map the valid rows (not -9999), old_idx is empty if no old polygons in the halo of this tile
+        for column, global_idx in [('old_index', old_idx), ('new_index', new_idx)]:
+            local_idx = df[column].values.astype(np.int64)
+            b_valid = local_idx >= 0
+            mapped_idx = np.full(len(local_idx), -9999, dtype=np.int64)
+            mapped_idx[b_valid] = global_idx[local_idx[b_valid]]
+            df[column] = mapped_idx
+        df['ChangeType'] = df['ChangeType'].values.astype(np.int64)
+        df['inters_num'] = df['inters_num'].values.astype(np.int64)
+
+    return tile_idx, expanding_df, shrinking_df, old_idx_intersect
+
+def get_expand_shrink_polygons_parallel(old_polygons, new_polygons, old_shp_path, new_shp_path, process_num,
+                                        tile_count=None, b_use_index=True, b_vectorized=False):
+    '''
+    partition the study area into tiles, compare old and new polygons of each tile in a process pool, then merge the
+    results in the order of polygon index, the output is the same as get_expand_shrink_polygons
+    :param old_polygons: a list of old polygons
+    :param new_polygons: a list of new polygons
+    :param old_shp_path: the path of the old polygons (for the file name)
+    :param new_shp_path: the path of the new polygons (for the file name)
+    :param process_num: the number of processes
+    :param tile_count: the tile count in x and y direction, if None, make about four tiles for each process
+    :return: expanding_df, shrinking_df
+    '''
+    if tile_count is None:
+        tile_count = int(math.ceil(math.sqrt(process_num*4)))
+    tiles = partition_polygons_to_tiles(old_polygons, new_polygons, tile_count)
+    basic.outputlogMessage('partition %d old and %d new polygons into %d tiles, run with %d processes' %
+                           (len(old_polygons), len(new_polygons), len(tiles), process_num))
+
+    parameters_list = [(t_idx, old_idx, new_idx, [old_polygons[idx] for idx in old_idx],
+                        [new_polygons[idx] for idx in new_idx], old_shp_path, new_shp_path, b_use_index, b_vectorized)
+                       for t_idx, (old_idx, new_idx) in enumerate(tiles)]
+    theadPool = Pool(process_num)
+    results = theadPool.starmap(get_expand_shrink_polygons_one_tile, parameters_list)
+    theadPool.close()
+    theadPool.join()
+
+    # each new polygon only belongs to one tile, so a stable sort on new_index keeps the order of old_index
+    expanding_df = pd.concat([res[1] for res in results], ignore_index=True)
+    expanding_df = expanding_df.sort_values('new_index', kind='stable').reset_index(drop=True)
+    shrinking_df = pd.concat([res[2] for res in results], ignore_index=True)
+    shrinking_df = shrinking_df.sort_values('new_index', kind='stable').reset_index(drop=True)
+
+    # new polygons intersecting more than one old polygons
+    inters_df = pd.concat([expanding_df[['new_index', 'inters_num']], shrinking_df[['new_index', 'inters_num']]])
+    inters_df = inters_df[inters_df['inters_num'] > 1].drop_duplicates('new_index').sort_values('new_index')
+    for idx_new, inters_num in zip(inters_df['new_index'].values, inters_df['inters_num'].values):
+        basic.outputlogMessage('Warning, the %dth new polygon intersect %d old polygons' % (idx_new, inters_num))
+
+    # find absent polygons in the old set of polygons
+    old_idx_intersect = np.unique(np.concatenate([res[3] for res in results]))
+    absent_indices = np.setdiff1d(np.arange(len(old_polygons)), old_idx_intersect).astype(np.int64)
+    if len(absent_indices) < 1:
+        basic.outputlogMessage('No polygon disappear in %s' % old_shp_path)
+    else:
+        absent_df = pd.DataFrame({'ChangeType': np.full(len(absent_indices), 4, dtype=np.int64),
+                                  'old_file': [os.path.basename(old_shp_path)] * len(absent_indices),
+                                  'old_index': absent_indices,
+                                  'new_file': [os.path.basename(new_shp_path)] * len(absent_indices),
+                                  'new_index': np.full(len(absent_indices), -9999, dtype=np.int64),
+                                  'inters_num': np.zeros(len(absent_indices), dtype=np.int64),
+                                  'PolygonShrink': [old_polygons[idx] for idx in absent_indices]
+                                  })
+        shrinking_df = pd.concat([shrinking_df, absent_df], ignore_index=True)
+
+    return expanding_df, shrinking_df
+
+def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink_save_path, b_use_index=True, b_vectorized=False,
+                              process_num=1, tile_count=None):
     '''
     change detection of polygons, compare their extent changes (only get the expanding part)
     :param old_shp_path: the path of the old polygons
     :param new_shp_path: the path of the new polygons
     :param expand_save_path: save path, the expanding area
     :param shrink_save_path: save path, the shrinking part (thaw slumps cannot shrink, the shrinking part is due to delineation error)
+    :param b_use_index: if True, use a STRtree of old polygons to find the intersecting ones, otherwise, check all old polygons
+    :param b_vectorized: if True, compute the changes of all pairs in bulk (need shapely >= 2.0)
+    :param process_num: if > 1, partition polygons into spatial tiles and compare them in parallel
+    :param tile_count: the tile count in x and y direction for the parallel version, None for automatic
     :return: True if successfully, False otherwise
     '''
     # check projection of the shape file, should be the same
@@ -47,6 +295,50 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
     if len(old_polygons) < 1:
         raise ValueError('No polygons in %s' % old_shp_path)
 
+    # read new polygons
+    new_polygons = vector_gpd.read_polygons_gpd(new_shp_path)
+    if len(new_polygons) < 1:
+        raise ValueError('No polygons in %s'% new_shp_path)
+
+    if b_vectorized and shapely.__version__ < '2':
+        basic.outputlogMessage('Warning, the vectorized version need shapely >= 2.0, but the version is %s, '
+                               'compare polygons one by one'%shapely.__version__)
+        b_vectorized = False
+
+    if process_num is not None and process_num > 1:
+        expanding_df, shrinking_df = get_expand_shrink_polygons_parallel(old_polygons, new_polygons, old_shp_path, new_shp_path,
+                                                                         process_num, tile_count=tile_count,
+                                                                         b_use_index=b_use_index, b_vectorized=b_vectorized)
+    elif b_vectorized:
+        expanding_df, shrinking_df = get_expand_shrink_polygons_vectorized(old_polygons, new_polygons, old_shp_path, new_shp_path)
+    else:
+        expanding_df, shrinking_df = get_expand_shrink_polygons(old_polygons, new_polygons, old_shp_path, new_shp_path,
+                                                                b_use_index=b_use_index)
+
+    wkt_string = map_projection.get_raster_or_vector_srs_info_wkt(old_shp_path)
+    if len(expanding_df) < 1:
+        basic.outputlogMessage("Warning, NO expanding polygons found, skip saving to %s"%expand_save_path)
+    else:
+        vector_gpd.save_polygons_to_files(expanding_df,'PolygonExpand', wkt_string, expand_save_path)
+    if len(shrinking_df) < 1:
+        basic.outputlogMessage("Warning, NO shrinking polygons found, skip saving to %s" % shrink_save_path)
+    else:
+        vector_gpd.save_polygons_to_files(shrinking_df,'PolygonShrink', wkt_string, shrink_save_path)
+
+    return True
+
+def get_expand_shrink_polygons(old_polygons, new_polygons, old_shp_path, new_shp_path, b_use_index=True, b_log=True):
+    '''
+    compare two groups of polygons, get the expanding (and new) parts and shrinking (and absent) parts
+    :param old_polygons: a list of old polygons
+    :param new_polygons: a list of new polygons
+    :param old_shp_path: the path of the old polygons (for the file name)
+    :param new_shp_path: the path of the new polygons (for the file name)
+    :param b_use_index: if True, use a STRtree of old polygons to find the intersecting ones, otherwise, check all old polygons
+    :param b_log: if False, don't output the messages (the index of polygons is local for a tile)
+    :return: expanding_df, shrinking_df
+    '''
+
     old_polygon_absent = [True] * len(old_polygons)
 
     change_type_list = []  # 1 for expanding and 2 for new
@@ -68,11 +360,9 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
     expand_intersect_num_list = []
     shrink_intersect_num_list = []
 
-
-    # read new polygons
-    new_polygons = vector_gpd.read_polygons_gpd(new_shp_path)
-    if len(new_polygons) < 1:
-        raise ValueError('No polygons in %s'% new_shp_path)
+    # build a spatial index of old polygons, avoid checking every pair of old and new polygons
+    if b_use_index:
+        old_tree, old_geom_id_to_idx = build_polygons_strtree(old_polygons)
 
     # compare these two groups of polygons:
     # changes include: (1) new, (2) absence, and (3) expanding or shrinking (thaw slumps)
@@ -82,17 +372,21 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
 
         # find expanding or shrinking parts (two polygons must have overlap)
         intersec_poly_index_list = []        # a new polygon may intersect more than one old polygons
-        for idx_old, a_old_polygon in enumerate(old_polygons):
-            intersection = a_old_polygon.intersection(a_new_polygon)
-            if intersection.is_empty is True:
-                continue
-            else:
-                intersec_poly_index_list.append(idx_old)
-
-                # indicate that this polygon is not absent
-                old_polygon_absent[idx_old] = False
-
-        if len(intersec_poly_index_list) > 1:
+        if b_use_index:
+            intersec_poly_index_list = get_intersect_polygon_index(a_new_polygon, old_polygons, old_tree, old_geom_id_to_idx)
+        else:
+            for idx_old, a_old_polygon in enumerate(old_polygons):
+                intersection = a_old_polygon.intersection(a_new_polygon)
+                if intersection.is_empty is True:
+                    continue
+                else:
+                    intersec_poly_index_list.append(idx_old)
+
+        # indicate that these polygons are not absent
+        for idx_old in intersec_poly_index_list:
+            old_polygon_absent[idx_old] = False
+
+        if len(intersec_poly_index_list) > 1 and b_log:
             basic.outputlogMessage('Warning, the %dth new polygon intersect %d old polygons'%(idx_new, len(intersec_poly_index_list)))
 
 
@@ -104,8 +398,9 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
             a_old_polygon = old_polygons[intersec_old_index]
             polygon_expand = a_new_polygon.difference(a_old_polygon)
             if polygon_expand.is_empty is True:
-                basic.outputlogMessage('info, no expanding found between %dth (old) and %dth (new, 0 index) in %s and %s'%
-                                 (intersec_old_index, idx_new, os.path.basename(old_shp_path),os.path.basename(new_shp_path) ))
+                if b_log:
+                    basic.outputlogMessage('info, no expanding found between %dth (old) and %dth (new, 0 index) in %s and %s'%
+                                     (intersec_old_index, idx_new, os.path.basename(old_shp_path),os.path.basename(new_shp_path) ))
             else:
                 polygon_expand_list.append(polygon_expand)
                 change_type_list.append(1)  # expanding
@@ -117,8 +412,9 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
 
             polygon_shrink = a_old_polygon.difference(a_new_polygon)
             if polygon_shrink.is_empty is True:
-                basic.outputlogMessage('info, no shrinking found between %dth (old) and %dth (new, 0 index) in %s and %s' %
-                    (intersec_old_index, idx_new, os.path.basename(old_shp_path), os.path.basename(new_shp_path)))
+                if b_log:
+                    basic.outputlogMessage('info, no shrinking found between %dth (old) and %dth (new, 0 index) in %s and %s' %
+                        (intersec_old_index, idx_new, os.path.basename(old_shp_path), os.path.basename(new_shp_path)))
             else:
                 polygon_shrink_list.append(polygon_shrink)
                 shrink_change_type_list.append(3)  # shrinking
@@ -128,7 +424,7 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
                 shrink_new_polygon_idx.append(idx_new)
                 shrink_intersect_num_list.append(len(intersec_poly_index_list))
 
-            if polygon_expand.is_empty is True and polygon_shrink.is_empty is True:
+            if polygon_expand.is_empty is True and polygon_shrink.is_empty is True and b_log:
                 basic.outputlogMessage('info, %dth (old) and %dth (new, 0 index) in %s and %s is identical' %
                     (intersec_old_index, idx_new, os.path.basename(old_shp_path), os.path.basename(new_shp_path)))
 
@@ -150,7 +446,8 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
     # find absent polygons in the old set of polygons
     absent_indices = [i for i, x in enumerate(old_polygon_absent) if x == True]
     if len(absent_indices) < 1:
-        basic.outputlogMessage('No polygon disappear in %s' % old_shp_path)
+        if b_log:
+            basic.outputlogMessage('No polygon disappear in %s' % old_shp_path)
     else:
         absent_indices = [ value for value in absent_indices]     # value+1
         # basic.outputlogMessage('Disappeared Polygons in %s: (index from 1) %s' % (old_shp_path, str(absent_indices)))
@@ -181,17 +478,7 @@ def polygons_change_detection(old_shp_path, new_shp_path,expand_save_path,shrink
                                  'PolygonShrink': polygon_shrink_list
                                 })
 
-    wkt_string = map_projection.get_raster_or_vector_srs_info_wkt(old_shp_path)
-    if len(polygon_expand_list) < 1:
-        basic.outputlogMessage("Warning, NO expanding polygons found, skip saving to %s"%expand_save_path)
-    else:
-        vector_gpd.save_polygons_to_files(expanding_df,'PolygonExpand', wkt_string, expand_save_path)
-    if len(polygon_shrink_list) < 1:
-        basic.outputlogMessage("Warning, NO shrinking polygons found, skip saving to %s" % shrink_save_path)
-    else:
-        vector_gpd.save_polygons_to_files(shrinking_df,'PolygonShrink', wkt_string, shrink_save_path)
-
-    return True
+    return expanding_df, shrinking_df
 
 def Multipolygon_to_Polygons(input_shp, ouptput_shp):
     '''
@@ -342,7 +629,8 @@ def main(options, args):
     # get expanding and shrinking parts
     output_path_expand = 'expand_' + main_shp_name
     output_path_shrink = 'shrink_' + main_shp_name
-    polygons_change_detection(old_shp_path, new_shp_path, output_path_expand,output_path_shrink)
+    polygons_change_detection(old_shp_path, new_shp_path, output_path_expand,output_path_shrink,
+                              b_vectorized=options.b_vectorized)
 
     # multi polygons to polygons, then add some information on the polygons
     all_change_polygons = 'all_changes_' + main_shp_name
@@ -367,6 +655,10 @@ if __name__ == "__main__":
                       action="store", dest = 'output',
                       help='the path to save the change detection results')
 
+    parser.add_option("--vectorized",
+                      action="store_true", dest="b_vectorized", default=False,
+                      help="compute the changes of all polygon pairs in bulk (need shapely >= 2.0)")
+
     (options, args) = parser.parse_args()
     if len(sys.argv) < 2:
         parser.print_help()
@@ -57,7 +57,7 @@ def get_main_shp_name(old_shp_path,new_shp_path):
 
     return main_shp_name
 
-def get_expanding_change(old_shp_path,new_shp_path,para_file, expanding_line_shp=None):
+def get_expanding_change(old_shp_path,new_shp_path,para_file, expanding_line_shp=None, process_num=1):
 
 
     main_shp_name = get_main_shp_name(old_shp_path, new_shp_path)
@@ -71,7 +71,8 @@ def get_expanding_change(old_shp_path,new_shp_path,para_file, expanding_line_shp
     # get expanding and shrinking parts
     output_path_expand = 'expand_' + main_shp_name
     output_path_shrink = 'shrink_' + main_shp_name
-    polygons_cd.polygons_change_detection(old_shp_path, new_shp_path, output_path_expand, output_path_shrink)
+    polygons_cd.polygons_change_detection(old_shp_path, new_shp_path, output_path_expand, output_path_shrink,
+                                          process_num=process_num)
 
     polygon_narrow_thr = parameters.get_digit_parameters_None_if_absence(para_file, 'polygon_narrow_threshold', 'float')
     #  if it is not None, then it will try to remove narrow parts of polygons
@@ -172,7 +173,10 @@ def get_expanding_change(old_shp_path,new_shp_path,para_file, expanding_line_shp
             'warning, minimum_relative_elevation is absent in the para file, skip removing polygons based on relative DEM')
 
     # added retreat distance (from medial axis)  # very time-consuming
-    cal_expand_area_distance(all_change_polygons,expand_line=expanding_line_shp, dem_path=dem_file, old_shp=old_shp_path)
+    # results of each polygon can be cached, then rerunning with different thresholds will be much faster
+    retreat_dis_cache_db = parameters.get_string_parameters_None_if_absence(para_file, 'retreat_dis_cache_db')
+    cal_expand_area_distance(all_change_polygons,expand_line=expanding_line_shp, dem_path=dem_file, old_shp=old_shp_path,
+                             cache_db=retreat_dis_cache_db)
 
 
     min_retreat_dis_thr = parameters.get_digit_parameters_None_if_absence(para_file, 'minimum_retreat_distance', 'float')
@@ -217,7 +221,8 @@ def main(options, args):
         # print(idx)
         output = 'change_' + get_main_shp_name(polygon_shps_list[idx], polygon_shps_list[idx + 1])
         if os.path.isfile(output) is False:
-            get_expanding_change(polygon_shps_list[idx], polygon_shps_list[idx+1], para_file, expanding_line_shp=expanding_lines[idx])
+            get_expanding_change(polygon_shps_list[idx], polygon_shps_list[idx+1], para_file, expanding_line_shp=expanding_lines[idx],
+                                 process_num=options.workers)
         else:
             basic.outputlogMessage('Warning, Polygon-based change detection results already exist')
         # conduct evaluation
@@ -241,6 +246,10 @@ if __name__ == "__main__":
                       action="store", dest = 'output',
                       help='the path to save the change detection results')
 
+    parser.add_option('-w', '--workers', type=int, default=1,
+                      action="store", dest='workers',
+                      help='the number of processes for comparing polygons in spatial tiles')
+
     (options, args) = parser.parse_args()
     if len(sys.argv) < 2:
         parser.print_help()
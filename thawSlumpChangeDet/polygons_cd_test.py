@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Filename: polygons_cd_test.py
+"""
+introduction: "pytest polygons_cd_test.py " or "pytest " for test, add " -s for allowing print out"
+"""
+import os,sys
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,code_dir)
+
+from shapely.geometry import box
+
+import polygons_cd
+
+def check_same_changes(df_a, df_b, geometry_column):
+    assert len(df_a) == len(df_b)
+    for column in ['ChangeType', 'old_index', 'new_index', 'inters_num']:
+        assert [int(item) for item in df_a[column]] == [int(item) for item in df_b[column]]
+    for poly_a, poly_b in zip(df_a[geometry_column], df_b[geometry_column]):
+        assert poly_a.equals(poly_b)
+
+def test_one_tile_without_old_polygons():
+    # a tile whose halo has no old polygons, all new polygons are new (2)
+    new_polygons = [box(50, 50, 51, 51), box(60, 60, 61, 61)]
+    _, expanding_df, shrinking_df, old_idx_intersect = polygons_cd.get_expand_shrink_polygons_one_tile(
+        0, [], [3, 7], [], new_polygons, 'old.shp', 'new.shp')
+    assert [int(item) for item in expanding_df['ChangeType']] == [2, 2]
+    assert [int(item) for item in expanding_df['old_index']] == [-9999, -9999]
+    assert [int(item) for item in expanding_df['new_index']] == [3, 7]
+    assert len(shrinking_df) == 0
+    assert len(old_idx_intersect) == 0
+
+def test_parallel_same_as_serial():
+    old_polygons = [box(0, 0, 1, 1)]
+    new_polygons = [box(0, 0, 1.5, 1.5), box(50, 50, 51, 51)]
+    serial_exp, serial_shr = polygons_cd.get_expand_shrink_polygons(old_polygons, new_polygons, 'old.shp', 'new.shp')
+    parallel_exp, parallel_shr = polygons_cd.get_expand_shrink_polygons_parallel(old_polygons, new_polygons,
+                                                                                 'old.shp', 'new.shp', 2)
+    check_same_changes(serial_exp, parallel_exp, 'PolygonExpand')
+    check_same_changes(serial_shr, parallel_shr, 'PolygonShrink')
+
+def test_parallel_absent_old_polygons():
+    # the second old polygon disappears, the second new polygon is in a tile without old polygons
+    old_polygons = [box(0, 0, 1, 1), box(10, 0, 11, 1)]
+    new_polygons = [box(0, 0, 0.5, 0.5), box(50, 50, 51, 51)]
+    serial_exp, serial_shr = polygons_cd.get_expand_shrink_polygons(old_polygons, new_polygons, 'old.shp', 'new.shp')
+    parallel_exp, parallel_shr = polygons_cd.get_expand_shrink_polygons_parallel(old_polygons, new_polygons,
+                                                                                 'old.shp', 'new.shp', 2, tile_count=4)
+    check_same_changes(serial_exp, parallel_exp, 'PolygonExpand')
+    check_same_changes(serial_shr, parallel_shr, 'PolygonShrink')
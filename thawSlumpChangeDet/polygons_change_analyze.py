@@ -27,8 +27,17 @@ from vector_features import shape_opeation
 
 import pandas as pd
 
+from shapely.ops import unary_union
+from polygons_cd import build_polygons_strtree
+from polygons_cd import get_intersect_polygon_index
+
+import math
+import numpy as np
+from shapely import wkb
+
 import multiprocessing
 from multiprocessing import Pool
+from multiprocessing import shared_memory
 
 # sys.path.insert(0, os.path.dirname(__file__))
 
@@ -97,13 +106,117 @@ def get_a_polygon_union_occurrence(polygon, polygons_list_2d, b_merged_2d, time_
 
     return union_polygon, occurrence, occur_time
 
-def get_polygon_union_occurrence_same_loc(polygons_list_2d):
+def get_union_merge_order(members, adjacency):
+    '''
+    get the order of polygons being merged into a union, the same as scanning polygons again and again in
+    get_a_polygon_union_occurrence until no new polygon is found
+    :param members: index of polygons in a connected component, in ascending order, the first one is the based polygon
+    :param adjacency: adjacency list, index of intersecting polygons for each polygon
+    :return: index of polygons in the merging order
+    '''
+    merged = {members[0]}
+    merge_order = [members[0]]
+    found_new_polygon = True
+    while found_new_polygon:
+        found_new_polygon = False
+        for m_idx in members:
+            if m_idx in merged:
+                continue
+            # intersect with the union is the same as intersect with one of its polygons
+            if any(nb in merged for nb in adjacency[m_idx]):
+                merged.add(m_idx)
+                merge_order.append(m_idx)
+                found_new_polygon = True
+    return merge_order
+
+def get_polygon_union_components(polygons_list_2d):
+    '''
+    get union of multi-temporal polygons at the same location: find intersecting pairs of all polygons once using a
+    spatial index, group them into connected components (union-find), then get the union of each component
+    :param polygons_list_2d: 2D list of polygons, from oldest to newest
+    :return: union_polygons_list, occurrence_list, occurrence_time_list,
+            union_idx_2d (2D list, the index of the union each polygon belongs to)
+    '''
+    # flatten polygons at all times, in order of (time, index)
+    all_polygons = [polygon for polygons in polygons_list_2d for polygon in polygons]
+    time_idx_list = [t_idx for t_idx, polygons in enumerate(polygons_list_2d) for _ in polygons]
+    if len(all_polygons) < 1:
+        return [], [], [], [[] for _ in polygons_list_2d]
+
+    parent = list(range(len(all_polygons)))
+    def find_root(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]     # path compression
+            idx = parent[idx]
+        return idx
+
+    tree, geom_id_to_idx = build_polygons_strtree(all_polygons)
+    adjacency = [[] for _ in all_polygons]
+    for idx, polygon in enumerate(all_polygons):
+        for nb_idx in get_intersect_polygon_index(polygon, all_polygons, tree, geom_id_to_idx):
+            if nb_idx <= idx:
+                continue
+            adjacency[idx].append(nb_idx)
+            adjacency[nb_idx].append(idx)
+            root_a, root_b = find_root(idx), find_root(nb_idx)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # components, in order of their first polygon, the same order as scanning polygons from oldest to newest
+    components = {}
+    for idx in range(len(all_polygons)):
+        components.setdefault(find_root(idx), []).append(idx)
+
+    union_polygons_list = []
+    occurrence_list = []
+    occurrence_time_list = []
+    union_idx_1d = [None] * len(all_polygons)
+    for u_idx, members in enumerate(components.values()):
+        merge_order = get_union_merge_order(members, adjacency)
+        union_polygons_list.append(unary_union([all_polygons[idx] for idx in members]))
+        occurrence_list.append(len(members))
+        occurrence_time_list.append([time_idx_list[idx] for idx in merge_order])
+        for idx in members:
+            union_idx_1d[idx] = u_idx
+
+    union_idx_2d = []
+    start = 0
+    for polygons in polygons_list_2d:
+        union_idx_2d.append(union_idx_1d[start:start + len(polygons)])
+        start += len(polygons)
+
+    return union_polygons_list, occurrence_list, occurrence_time_list, union_idx_2d
+
+def get_union_idx_of_polygons(polygons_list_2d, union_polygons_list):
+    '''
+    find the union each polygon belongs to. Unions do not intersect each other (otherwise they are merged), and
+    a polygon is inside its union, so check the union containing the representative point of the polygon
+    :param polygons_list_2d: 2D list of polygons, from oldest to newest
+    :param union_polygons_list: the unions of these polygons
+    :return: union_idx_2d (2D list, the index of the union each polygon belongs to)
+    '''
+    tree, geom_id_to_idx = build_polygons_strtree(union_polygons_list)
+    union_idx_2d = []
+    for polygons in polygons_list_2d:
+        union_idx_2d.append([get_intersect_polygon_index(polygon.representative_point(), union_polygons_list, tree,
+                                                         geom_id_to_idx)[0] for polygon in polygons])
+    return union_idx_2d
+
+def get_polygon_union_occurrence_same_loc(polygons_list_2d, b_union_find=True, b_union_idx=False):
     '''
     get union of multi-temporal polygons at the same location
     :param polygons_list_2d: 2D list of polygons, from oldest to newest
-    :return:
+    :param b_union_find: if True, use get_polygon_union_components, otherwise, grow each union by scanning all polygons
+    :param b_union_idx: if True, also return union_idx_2d (2D list, the index of the union each polygon belongs to)
+    :return: union_polygons_list, occurrence_list, occurrence_time_list, (and union_idx_2d if b_union_idx)
     '''
     basic.outputlogMessage('Get unions of multi-temporal polygons at the same location')
+    if b_union_find:
+        union_polygons_list, occurrence_list, occurrence_time_list, union_idx_2d = get_polygon_union_components(polygons_list_2d)
+        if b_union_idx:
+            return union_polygons_list, occurrence_list, occurrence_time_list, union_idx_2d
+        return union_polygons_list, occurrence_list, occurrence_time_list
+
     union_polygons_list = []
     # occurrence: each union polygons consist of how many of polygons.
     occurrence_list = []
@@ -132,6 +245,9 @@ def get_polygon_union_occurrence_same_loc(polygons_list_2d):
             occurrence_list.append(occurrence_count)
             occurrence_time_list.append(occurrence_time)
 
+    if b_union_idx:
+        union_idx_2d = get_union_idx_of_polygons(polygons_list_2d, union_polygons_list)
+        return union_polygons_list, occurrence_list, occurrence_time_list, union_idx_2d
     return union_polygons_list, occurrence_list, occurrence_time_list
 
 def max_IoU_score(polygon, polygon_list):
@@ -150,6 +266,78 @@ def max_IoU_score(polygon, polygon_list):
             max_idx = idx
     return max_iou, max_idx
 
+# polygons and unions shared by workers in the process pool (as WKB in shared memory), set by init_shared_polygons
+global_shared_memory = []
+global_polygon_wkb = None
+global_polygon_offsets = None
+global_union_wkb = None
+global_union_offsets = None
+global_union_idx = None
+global_union_cache = {}
+
+def polygons_to_shared_wkb(polygons):
+    '''
+    save polygons as WKB into one block of shared memory
+    :param polygons: a list of polygons
+    :return: the SharedMemory object, offsets (polygon i is in [offsets[i], offsets[i+1]) )
+    '''
+    wkb_list = [wkb.dumps(polygon) for polygon in polygons]
+    offsets = np.zeros(len(wkb_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in wkb_list])
+    shm = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+    shm.buf[:int(offsets[-1])] = b''.join(wkb_list)
+    return shm, offsets
+
+def init_shared_polygons(polygon_shm_name, polygon_offsets, union_shm_name, union_offsets, union_idx_1d):
+    '''
+    initializer of the process pool, attach to the shared memory storing polygons and unions,
+    so each worker gets them once for the entire run.
+    '''
+    global global_polygon_wkb, global_polygon_offsets, global_union_wkb, global_union_offsets, global_union_idx
+    polygon_shm = shared_memory.SharedMemory(name=polygon_shm_name)
+    union_shm = shared_memory.SharedMemory(name=union_shm_name)
+    global_shared_memory.extend([polygon_shm, union_shm])   # keep references, otherwise, the buffer will be released
+    global_polygon_wkb = polygon_shm.buf
+    global_polygon_offsets = polygon_offsets
+    global_union_wkb = union_shm.buf
+    global_union_offsets = union_offsets
+    global_union_idx = union_idx_1d
+    global_union_cache.clear()
+
+def get_shared_union(union_idx):
+    # each union is shared by several polygons, only decode it once
+    if union_idx not in global_union_cache:
+        global_union_cache[union_idx] = wkb.loads(bytes(global_union_wkb[global_union_offsets[union_idx]:global_union_offsets[union_idx + 1]]))
+    return global_union_cache[union_idx]
+
+def IoU_score_with_union(start_idx, end_idx):
+    '''
+    get the IoU score of polygons and the union they belong to. A polygon only intersects the union of its own
+    connected component, so the IoU with other unions is 0 and this is the max IoU score.
+    :param start_idx: the start index of polygons (in the shared memory)
+    :param end_idx: the end index (exclusive) of polygons
+    :return: a list of (IoU score, union_idx)
+    '''
+    results = []
+    for idx in range(start_idx, end_idx):
+        polygon = wkb.loads(bytes(global_polygon_wkb[global_polygon_offsets[idx]:global_polygon_offsets[idx + 1]]))
+        union_idx = int(global_union_idx[idx])
+        results.append((vector_features.IoU(polygon, get_shared_union(union_idx)), union_idx))
+    return results
+
+def get_process_num(para_file):
+    '''
+    get the number of processes from the para file (polygon_cd_process_num), use all the cores if it is absent
+    :param para_file: para file, can be None
+    :return: process number
+    '''
+    process_num = None
+    if para_file is not None and os.path.isfile(para_file):
+        process_num = parameters.get_digit_parameters_None_if_absence(para_file, 'polygon_cd_process_num', 'int')
+    if process_num is None:
+        process_num = multiprocessing.cpu_count()
+    return process_num
+
 def cal_multi_temporal_iou_and_occurrence(shp_list,para_file):
     '''
     calculate the IOU values of mapping polygons and their occurrence at the location across time
@@ -167,7 +355,8 @@ def cal_multi_temporal_iou_and_occurrence(shp_list,para_file):
         polygons_list_2d.append(polygons)
 
     # get union of polygons at the same location
-    union_polygons, occurrence_list, occur_time_list = get_polygon_union_occurrence_same_loc(polygons_list_2d)
+    union_polygons, occurrence_list, occur_time_list, union_idx_2d = \
+        get_polygon_union_occurrence_same_loc(polygons_list_2d, b_union_idx=True)
     # save the polygon changes
     union_id_list = [item+1 for item in range(len(union_polygons))]
     occur_time_str_list = []
@@ -187,40 +376,54 @@ def cal_multi_temporal_iou_and_occurrence(shp_list,para_file):
     basic.outputlogMessage('Save the union polygons to %s'%union_save_path)
 
 
-    # calculate IOU values and  the occurrence
-    for idx, shp in enumerate(shp_list):
-
-        polygons = polygons_list_2d[idx]
-        iou_list = []
-        occurrence = []
-        occurr_time = []
-
-        # results = []
-        # for polygon in polygons:
-        #     iou_value, max_idx = max_IoU_score(polygon, union_polygons)
-        #     results.append((iou_value,max_idx))
-
-        #####################################################################
-        # parallel getting medial axis of each polygon, then calculate distance.
-        num_cores = multiprocessing.cpu_count()
-        basic.outputlogMessage('number of thread %d' % num_cores)
-        theadPool = Pool(num_cores)  # multi processes
-        parameters_list = [(polygon,union_polygons) for polygon in polygons]
-        results = theadPool.starmap(max_IoU_score, parameters_list)  # need python3
-
-        for iou_value,max_idx in results:
-            iou_list.append(iou_value)
-            occurrence.append(occurrence_list[max_idx])
-            occur_time_str = [str(item) for item in occur_time_list[max_idx]]
-            occurr_time.append('_'.join(occur_time_str))
-
-        shp_obj = shape_opeation()
-        shp_obj.add_one_field_records_to_shapefile(shp, iou_list, 'time_iou')
-        shp_obj.add_one_field_records_to_shapefile(shp, occurrence, 'time_occur')
-        shp_obj.add_one_field_records_to_shapefile(shp, occurr_time, 'time_idx')
-
-
-        basic.outputlogMessage('Save IOU values and occurrence based on multi-temporal polygons to %s' % shp)
+    #####################################################################
+    # parallel calculating IoU of each polygon and the union it belongs to.
+    # all polygons and unions are put into shared memory (WKB) once, and the process pool is reused for all shapefiles
+    process_num = get_process_num(para_file)
+    basic.outputlogMessage('number of processes %d' % process_num)
+    all_polygons = [polygon for polygons in polygons_list_2d for polygon in polygons]
+    union_idx_1d = np.array([u_idx for union_idx_list in union_idx_2d for u_idx in union_idx_list], dtype=np.int64)
+    polygon_shm, polygon_offsets = polygons_to_shared_wkb(all_polygons)
+    union_shm, union_offsets = polygons_to_shared_wkb(union_polygons)
+
+    try:
+        with Pool(process_num, initializer=init_shared_polygons,
+                  initargs=(polygon_shm.name, polygon_offsets, union_shm.name, union_offsets, union_idx_1d)) as theadPool:
+
+            # calculate IOU values and  the occurrence
+            start_idx = 0
+            for idx, shp in enumerate(shp_list):
+
+                polygon_count = len(polygons_list_2d[idx])
+                iou_list = []
+                occurrence = []
+                occurr_time = []
+
+                # split polygons into chunks, about four chunks for each process
+                chunk_size = max(1, int(math.ceil(polygon_count / (process_num * 4.0))))
+                parameters_list = [(c_start, min(c_start + chunk_size, start_idx + polygon_count))
+                                   for c_start in range(start_idx, start_idx + polygon_count, chunk_size)]
+                chunk_results = theadPool.starmap(IoU_score_with_union, parameters_list)  # need python3
+                results = [item for chunk in chunk_results for item in chunk]
+                start_idx += polygon_count
+
+                for iou_value,max_idx in results:
+                    iou_list.append(iou_value)
+                    occurrence.append(occurrence_list[max_idx])
+                    occur_time_str = [str(item) for item in occur_time_list[max_idx]]
+                    occurr_time.append('_'.join(occur_time_str))
+
+                shp_obj = shape_opeation()
+                shp_obj.add_one_field_records_to_shapefile(shp, iou_list, 'time_iou')
+                shp_obj.add_one_field_records_to_shapefile(shp, occurrence, 'time_occur')
+                shp_obj.add_one_field_records_to_shapefile(shp, occurr_time, 'time_idx')
+
+
+                basic.outputlogMessage('Save IOU values and occurrence based on multi-temporal polygons to %s' % shp)
+    finally:
+        for shm in [polygon_shm, union_shm]:
+            shm.close()
+            shm.unlink()
 
 
 
@@ -46,7 +46,8 @@ def main(options, args):
     # get expanding and shrinking parts
     output_path_expand = 'expand_' + main_shp_name
     output_path_shrink = 'shrink_' + main_shp_name
-    polygons_cd.polygons_change_detection(old_shp_path, new_shp_path, output_path_expand,output_path_shrink)
+    polygons_cd.polygons_change_detection(old_shp_path, new_shp_path, output_path_expand,output_path_shrink,
+                                          process_num=options.workers)
 
 
 
@@ -63,6 +64,10 @@ if __name__ == "__main__":
                       action="store", dest = 'output',
                       help='the path to save the change detection results')
 
+    parser.add_option('-w', '--workers', type=int, default=1,
+                      action="store", dest='workers',
+                      help='the number of processes for comparing polygons in spatial tiles')
+
     (options, args) = parser.parse_args()
     if len(sys.argv) < 2:
         parser.print_help()
@@ -18,6 +18,7 @@ import basic_src.io_function as io_function
 
 import parameters
 import geopandas as gpd
+import pandas as pd
 import vector_gpd
 import numpy as np
 
@@ -33,6 +34,20 @@ def get_polygon_idx_and_time_iou(ref_polygon, shapefile_gpd):
 
     return None, None, None
 
+def get_first_intersect_polygon_position(union_gpd, shapefile_gpd):
+    '''
+    for each union polygon, find the first polygon (in the row order) in shapefile_gpd intersecting it,
+    the same as calling get_polygon_idx_and_time_iou for each union polygon, but using one spatial join
+    :param union_gpd: GeoDataFrame of union polygons (with a RangeIndex)
+    :param shapefile_gpd: GeoDataFrame of polygons at one time
+    :return: a numpy array of the row position in shapefile_gpd, -1 if no polygon intersects the union polygon
+    '''
+    joined = gpd.sjoin(union_gpd, shapefile_gpd[['geometry']], how='inner', predicate='intersects')
+    first_pos = pd.Series(shapefile_gpd.index.get_indexer(joined['index_right']), index=joined.index).groupby(level=0).min()
+    position = np.full(len(union_gpd), -1, dtype=np.int64)
+    position[first_pos.index.values] = first_pos.values
+    return position
+
 def remove_non_active_thaw_slumps(shp_list,para_file):
     '''
     remove polygons based on information from multi-temporal polygons
@@ -130,27 +145,30 @@ def remove_non_active_thaw_slumps(shp_list,para_file):
     #         continue
 
     # based on each union polygons, to read time_iou, allow each location has various polygons #
-    for idx, union_poly in enumerate(union_polygons):  # shapefile_list[0].geometry.values
-        time_iou_values = []
-        idx_list = []
-        for time in range(0, normal_occurrence):
-            t_idx, t_iou, t_polygon = get_polygon_idx_and_time_iou(union_poly,shapefile_list[time])
-            time_iou_values.append(t_iou)
-            idx_list.append(t_idx)
-
-        # remove none value
-        if None in idx_list:
-            time_iou_values.remove(None)
-
-        # check if time iou is monotonically increasing
-        time_iou_array = np.array(time_iou_values, dtype=np.float64)       # specify the dtype to avoid unexpected error
-        if np.all(np.diff(time_iou_array) >= iou_mono_increasing_thr):
-            pass
-        else:
-            basic.outputlogMessage('The areas of Polygons %s : iou: %s in temporal shapefiles is not monotonically increasing, remove them'%
-                                   (str(idx_list), str(time_iou_values)))
-            rm_polygon_idx_2d.append(idx_list)
-        # print(time_iou_values, rm_polygon_idx_2d)
+    # join union polygons with polygons at each time, get a U x T matrix of time_iou
+    union_gpd = gpd.GeoDataFrame(geometry=list(union_polygons), crs=shapefile_list[0].crs)
+    position_2d = np.stack([get_first_intersect_polygon_position(union_gpd, shapefile_list[time])
+                            for time in range(normal_occurrence)], axis=1).reshape(len(union_gpd), normal_occurrence)
+    time_iou_2d = np.full(position_2d.shape, np.nan, dtype=np.float64)  # specify the dtype to avoid unexpected error
+    for time in range(normal_occurrence):
+        b_found = position_2d[:, time] >= 0
+        time_iou_2d[b_found, time] = shapefile_list[time]['time_iou'].values[position_2d[b_found, time]]
+
+    # check if time iou is monotonically increasing
+    b_complete = np.all(position_2d >= 0, axis=1)
+    b_mono_increase = np.zeros(len(union_gpd), dtype=bool)
+    b_mono_increase[b_complete] = np.all(np.diff(time_iou_2d[b_complete], axis=1) >= iou_mono_increasing_thr, axis=1)
+    for idx in np.where(~b_complete)[0]:
+        # remove none value (only the first one, as before)
+        time_iou_values = np.delete(time_iou_2d[idx], np.where(position_2d[idx] < 0)[0][0])
+        b_mono_increase[idx] = np.all(np.diff(time_iou_values) >= iou_mono_increasing_thr)
+
+    for idx in np.where(~b_mono_increase)[0]:
+        idx_list = [shapefile_list[time].index[pos] if pos >= 0 else None for time, pos in enumerate(position_2d[idx])]
+        time_iou_values = [value for value in time_iou_2d[idx] if not np.isnan(value)]
+        basic.outputlogMessage('The areas of Polygons %s : iou: %s in temporal shapefiles is not monotonically increasing, remove them'%
+                               (str(idx_list), str(time_iou_values)))
+        rm_polygon_idx_2d.append(idx_list)
 
     remove_count = len(rm_polygon_idx_2d)
     for rm_idx_list in rm_polygon_idx_2d:
@@ -10,6 +10,11 @@ add time: 05 November, 2019
 
 import sys,os
 from optparse import OptionParser
+import zipfile
+import hashlib
+import shutil
+import time
+import random
 
 import torch
 from torch import nn
@@ -18,6 +23,12 @@ from torchvision import transforms
 from torch import optim
 
 import numpy as np
+import multiprocessing
+import multiprocessing.connection
+from numpy.lib.stride_tricks import sliding_window_view
+import rasterio
+from rasterio.windows import Window
+import rasterio.features
 
 # add the upper level path for importing dataTools model
 script_folder = os.path.dirname(sys.argv[0])
@@ -28,9 +39,9 @@ from dataTools.img_pairs import two_images_pixel_pair
 from dataTools.img_pairs import read_img_pair_paths
 from dataTools.img_pairs import save_image_oneband_8bit
 
-sys.path.insert(0,os.path.expanduser('~/codes/PycharmProjects/DeeplabforRS'))
-import split_image
-import basic_src.RSImageProcess as RSImageProcess
+
+# the value in change maps for skipped pixels (nodata or outside the area of interest)
+change_map_nodata = 255
 
 class ToTensor(object):
     """Convert ndarrays read by rasterio to Tensors."""
@@ -56,21 +67,25 @@ class Net(nn.Module):
 
         self.linear2 = nn.Linear(512, 2)
 
+    def trunk(self, x):
+        x = self.conv1(x)
+        x = F.relu(x)
+        x = self.pool1(x)
+        x = self.conv2(x)
+        x = F.relu(x)
+        x = self.conv3(x)
+        x = F.relu(x)
+
+        x = x.view(x.shape[0], -1)
+        x = self.linear1(x)
+        return F.relu(x)
+
     def forward(self, data):
-        res = []
-        for i in range(2):  # Siamese nets; sharing weights
-            x = data[i]
-            x = self.conv1(x)
-            x = F.relu(x)
-            x = self.pool1(x)
-            x = self.conv2(x)
-            x = F.relu(x)
-            x = self.conv3(x)
-            x = F.relu(x)
-
-            x = x.view(x.shape[0], -1)
-            x = self.linear1(x)
-            res.append(F.relu(x))
+        # Siamese nets; sharing weights
+        # run the old and new patches as one batch, then split the features
+        batch_count = data[0].shape[0]
+        x = self.trunk(torch.cat((data[0], data[1]), dim=0))
+        res = [x[:batch_count], x[batch_count:]]
 
         # The crucial step of the whole procedure is the next one:
         # we calculate the squared distance of the feature vectors.
@@ -84,12 +99,58 @@ class Net(nn.Module):
         res = self.linear2(res)
         return res
 
+class NetDense(nn.Module):
+    '''
+    the fully-convolutional version of Net, for predicting all pixels of an image (or a strip) in one pass.
+    Net outputs the label of the center pixel of a 28 by 28 patch, here, the max pooling uses stride 1 and
+    the following convolutions are dilated by 2, so the outputs keep the full resolution,
+    linear1 becomes a 3 by 3 convolution (dilation 2) and linear2 becomes a 1 by 1 convolution.
+    It uses the weights of the Net directly, so the results are the same as running Net on each patch.
+    '''
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+        self.dilation = net.pool1.kernel_size   # 2
+
+    def trunk(self, x):
+        net = self.net
+        x = net.conv1(x)
+        x = F.relu(x)
+        x = F.max_pool2d(x, self.dilation, stride=1)
+        x = F.conv2d(x, net.conv2.weight, net.conv2.bias, dilation=self.dilation)
+        x = F.relu(x)
+        x = F.conv2d(x, net.conv3.weight, net.conv3.bias, dilation=self.dilation)
+        x = F.relu(x)
+
+        # linear1 on the flatten 256*3*3 features is a 3 by 3 convolution
+        weight = net.linear1.weight.view(net.linear1.out_features, net.conv3.out_channels, 3, 3)
+        x = F.conv2d(x, weight, net.linear1.bias, dilation=self.dilation)
+        return F.relu(x)
+
+    def head(self, old_features, new_features):
+        res = torch.abs(new_features - old_features)
+        weight = self.net.linear2.weight.view(self.net.linear2.out_features, self.net.linear2.in_features, 1, 1)
+        res = F.conv2d(res, weight, self.net.linear2.bias)
+        return res      # shape: (batch, 2, height, width)
+
+    def forward(self, data):
+        batch_count = data[0].shape[0]
+        x = self.trunk(torch.cat((data[0], data[1]), dim=0))
+        return self.head(x[:batch_count], x[batch_count:])
+
 
 def train(model, device, train_loader, epoch, optimizer, batch_size):
     model.train()
     total_loss = 0
     iter_count = 0
+    sample_count = 0
+    data_time = 0.0         # time waiting for the data loader
+    compute_time = 0.0      # time for moving data to device, forward, backward, and updating
+    t_start = time.time()
+    t_end = t_start
     for batch_idx, (data, target) in enumerate(train_loader):
+        t_data = time.time()
+        data_time += t_data - t_end
         for i in range(len(data)):
             data[i] = data[i].to(device)
 
@@ -113,9 +174,66 @@ def train(model, device, train_loader, epoch, optimizer, batch_size):
                        100. * batch_idx * batch_size / len(train_loader.dataset),
                 loss.item()))
 
-        total_loss += loss.item()
+        total_loss += loss.item()   # item() waits for the computation to finish
         iter_count += 1
-    return total_loss/iter_count
+        sample_count += len(label_target)
+        t_end = time.time()
+        compute_time += t_end - t_data
+
+    epoch_time = time.time() - t_start
+    speed_info = {'samples_per_sec': sample_count / epoch_time, 'data_time': data_time, 'compute_time': compute_time}
+    print('Train Epoch: {}\tsamples/sec: {:.1f}, waiting for data: {:.1f} s, compute: {:.1f} s, total: {:.1f} s'.format(
+        epoch, speed_info['samples_per_sec'], data_time, compute_time, epoch_time))
+    return total_loss/iter_count, speed_info
+
+def save_checkpoint(checkpoint_path, model, optimizer, epoch, history):
+    '''
+    save everything for resuming the training
+    :param checkpoint_path: the save path
+    :param model: the model
+    :param optimizer: the optimizer
+    :param epoch: the epoch just finished
+    :param history: a dict of the loss, accuracy, and speed of previous epochs
+    :return:
+    '''
+    checkpoint = {'epoch': epoch,
+                  'model_state_dict': model.state_dict(),
+                  'optimizer_state_dict': optimizer.state_dict(),
+                  'history': history,
+                  'torch_rng_state': torch.get_rng_state(),
+                  'numpy_rng_state': np.random.get_state(),
+                  'python_rng_state': random.getstate()}
+    if torch.cuda.is_available():
+        checkpoint['cuda_rng_state'] = torch.cuda.get_rng_state_all()
+    # write to a temporary file first, then the checkpoint is still valid if the job is killed during saving
+    tmp_path = checkpoint_path + '.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, checkpoint_path)
+
+def load_checkpoint(checkpoint_path, model, optimizer, device):
+    '''
+    load a checkpoint saved by save_checkpoint
+    :param checkpoint_path: the checkpoint path
+    :param model: the model, the weights will be replaced
+    :param optimizer: the optimizer, the state will be replaced
+    :param device:
+    :return: the epoch for starting, history
+    '''
+    try:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    except TypeError:   # old PyTorch does not have weights_only
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    # load to CPU, the RNG states must be CPU tensors, load_state_dict copies the weights and
+    # optimizer states to the device of the model
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    torch.set_rng_state(checkpoint['torch_rng_state'])
+    np.random.set_state(checkpoint['numpy_rng_state'])
+    random.setstate(checkpoint['python_rng_state'])
+    if 'cuda_rng_state' in checkpoint and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint['cuda_rng_state'])
+    print('Resume from %s, the last finished epoch: %d' % (checkpoint_path, checkpoint['epoch']))
+    return checkpoint['epoch'] + 1, checkpoint['history']
 
 def test(model, device, test_loader):
     model.eval()
@@ -160,8 +278,528 @@ def oneshot(model, device, data):
         output = model(data)
         return torch.squeeze(torch.argmax(output, dim=1)).cpu().item()
 
+def predict_padded_image_dense(model, device, old_image_pad, new_image_pad, trans, win_size=28, strip_rows=64,
+                               old_features=None, valid_mask=None):
+    '''
+    predict all pixels of a padded image pair using NetDense, the image is processed strip by strip to limit memory
+    :param model: a trained Net
+    :param device:
+    :param old_image_pad: the padded old image, shape (ncount, height + win_size - 1, width + win_size - 1),
+                          not used (can be None) if old_features is given
+    :param new_image_pad: the padded new image, the same shape as the old one
+    :param trans: the transform applied to the image patches
+    :param win_size: window size of the patches, must be 28 for Net
+    :param strip_rows: the number of rows predicted in one pass
+    :param old_features: the trunk features of the old image, shape (512, height, width), see get_old_feature_cache
+    :param valid_mask: 2d boolean array (height, width), only predict the columns and rows having valid pixels,
+                       None for predicting all pixels
+    :return: the change map, 2d numpy array (uint8)
+    '''
+    if win_size != 28:
+        raise ValueError('error, the window size of Net is 28, not %d' % win_size)
+    if isinstance(model, Net) is False:
+        raise ValueError('error, dense prediction needs the weights of Net, not a TorchScript or quantized model')
+    model_dense = NetDense(model)
+    model_dense.eval()
+
+    height = new_image_pad.shape[1] - win_size + 1
+    width = new_image_pad.shape[2] - win_size + 1
+    predicted_change_2d = np.zeros((height, width), dtype=np.uint8)
+    with torch.no_grad():
+        for row in range(0, height, strip_rows):
+            row_stop = min(row + strip_rows, height)
+            col, col_stop = 0, width
+            if valid_mask is not None:
+                # skip the strip without valid pixels, or only predict the columns between valid pixels
+                valid_cols = np.nonzero(valid_mask[row:row_stop].any(axis=0))[0]
+                if len(valid_cols) < 1:
+                    continue
+                col, col_stop = valid_cols[0], valid_cols[-1] + 1
+
+            new_strip = new_image_pad[:, row:row_stop + win_size - 1, col:col_stop + win_size - 1]
+            if old_features is None:
+                old_strip = old_image_pad[:, row:row_stop + win_size - 1, col:col_stop + win_size - 1]
+                data = [trans(old_strip).unsqueeze(0).to(device), trans(new_strip).unsqueeze(0).to(device)]
+                out_prop = model_dense(data)
+            else:
+                # only run the new image
+                old_feature = torch.from_numpy(old_features[:, row:row_stop, col:col_stop].astype(np.float32)).unsqueeze(0).to(device)
+                new_feature = model_dense.trunk(trans(new_strip).unsqueeze(0).to(device))
+                out_prop = model_dense.head(old_feature, new_feature)
+            predicted_change_2d[row:row_stop, col:col_stop] = torch.argmax(out_prop, dim=1)[0].cpu().numpy()
+
+    return predicted_change_2d
+
+def predict_padded_image_patches(model, device, old_image_pad, new_image_pad, trans, win_size=28, batch_size=32,
+                                 valid_mask=None):
+    '''
+    predict all pixels of a padded image pair using Net, patch by patch (in batches)
+    :param model: a trained Net
+    :param device:
+    :param old_image_pad: the padded old image, shape (ncount, height + win_size - 1, width + win_size - 1)
+    :param new_image_pad: the padded new image, the same shape as the old one
+    :param trans: the transform applied to the image patches
+    :param win_size: window size of the patches
+    :param batch_size: the batch size
+    :param valid_mask: 2d boolean array (height, width), only predict valid pixels, None for predicting all pixels
+    :return: the change map, 2d numpy array (uint8)
+    '''
+    height = old_image_pad.shape[1] - win_size + 1
+    width = old_image_pad.shape[2] - win_size + 1
+    old_view = sliding_window_view(old_image_pad, (win_size, win_size), axis=(1, 2))
+    new_view = sliding_window_view(new_image_pad, (win_size, win_size), axis=(1, 2))
+
+    if valid_mask is None:
+        pixel_idx = np.arange(height * width)
+    else:
+        pixel_idx = np.flatnonzero(valid_mask)
+
+    predicted_change = np.zeros(height * width, dtype=np.uint8)
+    with torch.no_grad():
+        for start in range(0, len(pixel_idx), batch_size):
+            batch_pixel_idx = pixel_idx[start:start + batch_size]
+            rows, cols = np.divmod(batch_pixel_idx, width)
+            old_patches = np.moveaxis(old_view[:, rows, cols], 0, 1)    # (count, nband, win_size, win_size)
+            new_patches = np.moveaxis(new_view[:, rows, cols], 0, 1)
+            data = [trans(np.ascontiguousarray(old_patches)).to(device), trans(np.ascontiguousarray(new_patches)).to(device)]
+
+            out_prop = model(data)
+            predicted_change[batch_pixel_idx] = torch.argmax(out_prop, dim=1).cpu().numpy()
+
+    return predicted_change.reshape(height, width)
+
+def predict_image_dense(model, device, old_image_array, new_image_array, trans, win_size=28, strip_rows=64):
+    '''
+    predict all pixels of an image pair using NetDense
+    :param model: a trained Net
+    :param device:
+    :param old_image_array: the old image, shape (ncount, height, width)
+    :param new_image_array: the new image, the same shape as the old one
+    :param trans: the transform applied to the image patches
+    :param win_size: window size of the patches, must be 28 for Net
+    :param strip_rows: the number of rows predicted in one pass
+    :return: the change map, 2d numpy array (uint8)
+    '''
+    # pad the same as two_images_pixel_pair, the pixel is at (14,14) of its 28 by 28 patch
+    pad_width = img_pairs.get_pad_width((win_size, win_size))
+    old_image_pad = np.pad(old_image_array, pad_width, mode='constant', constant_values=0)
+    new_image_pad = np.pad(new_image_array, pad_width, mode='constant', constant_values=0)
+    return predict_padded_image_dense(model, device, old_image_pad, new_image_pad, trans, win_size=win_size, strip_rows=strip_rows)
+
+def get_change_map_profile(new_src, nodata=None):
+    '''
+    get the profile of the change map (a tiled GeoTIFF), using the new image as reference
+    :param new_src: the opened new image
+    :param nodata: the nodata value of the change map
+    :return: the profile
+    '''
+    profile = new_src.profile
+    profile.update(driver='GTiff', dtype=rasterio.uint8, count=1, nodata=nodata,
+                   tiled=True, blockxsize=256, blockysize=256, compress='lzw')
+    return profile
+
+def get_block_windows(height, width, block_width, block_height):
+    '''
+    split an image into blocks
+    :return: a list of (xoff, yoff, xsize, ysize)
+    '''
+    windows = []
+    for yoff in range(0, height, block_height):
+        for xoff in range(0, width, block_width):
+            windows.append((xoff, yoff, min(block_width, width - xoff), min(block_height, height - yoff)))
+    return windows
+
+def read_block_with_halo(src, block, win_size=28):
+    '''
+    read a block with a halo of half window, pixels outside the image are 0, the same as padding the entire image
+    :param src: the opened image
+    :param block: (xoff, yoff, xsize, ysize)
+    :param win_size: window size of the patches
+    :return: the padded block, shape (ncount, ysize + win_size - 1, xsize + win_size - 1)
+    '''
+    xoff, yoff, xsize, ysize = block
+    pad_before, pad_after = img_pairs.get_pad_width((win_size, win_size))[1]
+    halo_window = Window(xoff - pad_before, yoff - pad_before, xsize + pad_before + pad_after,
+                         ysize + pad_before + pad_after)
+    return src.read(window=halo_window, boundless=True, fill_value=0)
+
+def get_model_hash(model):
+    sha = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        sha.update(name.encode('utf-8'))
+        sha.update(value.cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+def get_old_feature_cache(model, device, old_img_path, trans, cache_dir, win_size=28, block_width=1024,
+                          block_height=1024, strip_rows=64, b_fp16=False):
+    '''
+    compute the trunk features (output of linear1 in NetDense) of an old image and save them as a .npy file (float32,
+    2 KB per pixel, or float16 if b_fp16), then comparing the old image with several new images only need to run the
+    new images. The file name contains a hash of the image path, modified time, the model weights, and the data type,
+    so it will be rebuilt if any of them changes.
+    If the free space of cache_dir is not enough, return None, then the features are computed again for each new image.
+    :param model: a trained Net
+    :param device:
+    :param old_img_path: the old image
+    :param trans: the transform applied to the image patches
+    :param cache_dir: the folder for saving features
+    :param win_size: window size of the patches, must be 28 for Net
+    :param block_width: the width of a block for reading the image
+    :param block_height: the height of a block for reading the image
+    :param strip_rows: the number of rows computed in one pass
+    :param b_fp16: if True, save features as float16 (half the disk space), but the change maps may be slightly
+                   different from the ones without the cache (float32)
+    :return: the path of the .npy file, shape (512, height, width), or None if there is not enough disk space
+    '''
+    if isinstance(model, Net) is False:
+        raise ValueError('error, caching features needs the weights of Net, not a TorchScript or quantized model')
+    old_img_path = os.path.abspath(old_img_path)
+    feature_dtype = np.float16 if b_fp16 else np.float32
+    key = '%s|%f|%s|%s' % (old_img_path, os.path.getmtime(old_img_path), get_model_hash(model), np.dtype(feature_dtype).name)
+    file_name = os.path.splitext(os.path.basename(old_img_path))[0]
+    npy_path = os.path.join(cache_dir, '%s_features_%s.npy' % (file_name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+    if os.path.isfile(npy_path):
+        return npy_path
+
+    if os.path.isdir(cache_dir) is False:
+        os.makedirs(cache_dir, exist_ok=True)
+    height, width = img_pairs.get_image_height_width(old_img_path)
+    feature_shape = (model.linear1.out_features, height, width)
+    need_bytes = int(np.prod(feature_shape, dtype=np.int64)) * np.dtype(feature_dtype).itemsize
+    free_bytes = shutil.disk_usage(cache_dir).free
+    if need_bytes > free_bytes:
+        print('warning, caching features of %s needs %.1f GB, but only %.1f GB free in %s, not use the cache'
+              % (old_img_path, need_bytes / 1024.0**3, free_bytes / 1024.0**3, cache_dir))
+        return None
+
+    print('Compute features of %s, save to %s' % (old_img_path, npy_path))
+    model_dense = NetDense(model)
+    model_dense.eval()
+    tmp_path = npy_path + '.tmp%d' % os.getpid()
+    with rasterio.open(old_img_path) as old_src, torch.no_grad():
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=feature_dtype, shape=feature_shape)
+        for block in get_block_windows(old_src.height, old_src.width, block_width, block_height):
+            xoff, yoff, xsize, ysize = block
+            old_block = read_block_with_halo(old_src, block, win_size)
+            for row in range(0, ysize, strip_rows):
+                row_stop = min(row + strip_rows, ysize)
+                old_strip = old_block[:, row:row_stop + win_size - 1, :]
+                feature = model_dense.trunk(trans(old_strip).unsqueeze(0).to(device))
+                features[:, yoff + row:yoff + row_stop, xoff:xoff + xsize] = feature[0].cpu().numpy().astype(feature_dtype)
+        features.flush()
+        del features
+    os.replace(tmp_path, npy_path)
+    return npy_path
+
+def read_aoi_polygons(aoi_shp, crs):
+    '''
+    read polygons of the area of interest (AOI)
+    :param aoi_shp: a shapefile (or other vector file) of the AOI
+    :param crs: the coordinate reference system of the image, the polygons will be reprojected to it
+    :return: a list of polygons
+    '''
+    import geopandas as gpd
+    aoi = gpd.read_file(aoi_shp)
+    if aoi.crs is not None and crs is not None and aoi.crs != crs:
+        aoi = aoi.to_crs(crs)
+    polygons = [geom for geom in aoi.geometry if geom is not None and geom.is_empty is False]
+    if len(polygons) < 1:
+        raise ValueError('error, no polygons in %s' % aoi_shp)
+    return polygons
+
+def get_block_valid_mask(old_src, new_src, block, aoi_polygons=None):
+    '''
+    get the valid pixels of a block: valid in both old and new images (nodata, mask band, or alpha band),
+    and inside the area of interest if aoi_polygons is given
+    :param old_src: the opened old image
+    :param new_src: the opened new image
+    :param block: (xoff, yoff, xsize, ysize)
+    :param aoi_polygons: polygons of the area of interest, in the projection of the new image, None for no AOI
+    :return: 2d boolean array (ysize, xsize)
+    '''
+    window = Window(*block)
+    valid_mask = (old_src.dataset_mask(window=window) > 0) & (new_src.dataset_mask(window=window) > 0)
+    if aoi_polygons is not None and valid_mask.any():
+        valid_mask &= rasterio.features.geometry_mask(aoi_polygons, out_shape=valid_mask.shape,
+                                                      transform=new_src.window_transform(window), invert=True)
+    return valid_mask
+
+def predict_one_block(model, device, old_src, new_src, block, trans, win_size=28, batch_size=32, b_dense=False,
+                      old_features=None, valid_mask=None):
+    '''
+    predict a block of an image pair, the block is read with a halo,
+    pixels outside the image are 0, the same as padding the entire image
+    :param model: a trained Net
+    :param device:
+    :param old_src: the opened old image
+    :param new_src: the opened new image
+    :param block: (xoff, yoff, xsize, ysize)
+    :param trans: the transform applied to the image patches
+    :param win_size: window size of the patches
+    :param batch_size: the batch size (not used in dense prediction)
+    :param b_dense: if True, use NetDense
+    :param old_features: the trunk features of the entire old image (from get_old_feature_cache), None for not using
+    :param valid_mask: 2d boolean array of the block (from get_block_valid_mask), invalid pixels are not predicted
+                       and set as change_map_nodata, None for predicting all pixels
+    :return: the change map of the block, 2d numpy array (uint8)
+    '''
+    xoff, yoff, xsize, ysize = block
+    if valid_mask is not None and not valid_mask.any():
+        # skip reading and predicting
+        return np.full((ysize, xsize), change_map_nodata, dtype=np.uint8)
+
+    new_block = read_block_with_halo(new_src, block, win_size)
+    if old_features is not None:
+        if b_dense is False:
+            raise ValueError('error, the cached features of the old image only work with dense prediction')
+        change_block = predict_padded_image_dense(model, device, None, new_block, trans, win_size=win_size,
+                                                  old_features=old_features[:, yoff:yoff + ysize, xoff:xoff + xsize],
+                                                  valid_mask=valid_mask)
+    else:
+        old_block = read_block_with_halo(old_src, block, win_size)
+        if b_dense:
+            change_block = predict_padded_image_dense(model, device, old_block, new_block, trans, win_size=win_size,
+                                                      valid_mask=valid_mask)
+        else:
+            change_block = predict_padded_image_patches(model, device, old_block, new_block, trans,
+                                                        win_size=win_size, batch_size=batch_size, valid_mask=valid_mask)
+
+    if valid_mask is not None:
+        change_block[~valid_mask] = change_map_nodata
+    return change_block
+
+def predict_large_image_by_blocks(model, device, image_pair, save_path, trans, win_size=28, block_width=1024,
+                                  block_height=1024, batch_size=32, b_dense=False, feature_cache_dir=None,
+                                  b_mask=False, aoi_shp=None, b_feature_fp16=False):
+    '''
+    predict a large image block by block: read each block with a halo from the old and new image,
+    then write the result of the block to a tiled GeoTIFF directly, the memory usage depends on the block size
+    :param model: a trained Net
+    :param device:
+    :param image_pair: [old_image, new_image, label_path (if available)]
+    :param save_path: the path for saving the change map
+    :param trans: the transform applied to the image patches
+    :param win_size: window size of the patches
+    :param block_width: the width of a block
+    :param block_height: the height of a block
+    :param batch_size: the batch size (not used in dense prediction)
+    :param b_dense: if True, use NetDense
+    :param feature_cache_dir: a folder for caching features of the old image, None for not using the cache
+    :param b_mask: if True, skip nodata pixels of the old and new image, and save them as change_map_nodata
+    :param aoi_shp: a vector file of the area of interest, skip pixels outside it (also set b_mask as True)
+    :param b_feature_fp16: if True, cache the features as float16
+    :return: True if successful
+    '''
+    img_pairs.check_image_pairs(image_pair)
+    old_img_path = image_pair[0]
+    # use the new image as projection reference, the same as predict_small_image_or_subset
+    new_img_path = image_pair[1]
+
+    old_features = None
+    if feature_cache_dir is not None:
+        feature_path = get_old_feature_cache(model, device, old_img_path, trans, feature_cache_dir, win_size=win_size,
+                                             block_width=block_width, block_height=block_height, b_fp16=b_feature_fp16)
+        if feature_path is not None:
+            old_features = np.load(feature_path, mmap_mode='r')
+
+    b_mask = b_mask or aoi_shp is not None
+    with rasterio.open(old_img_path) as old_src, rasterio.open(new_img_path) as new_src:
+        aoi_polygons = None if aoi_shp is None else read_aoi_polygons(aoi_shp, new_src.crs)
+        profile = get_change_map_profile(new_src, nodata=change_map_nodata if b_mask else None)
+        with rasterio.open(save_path, 'w', **profile) as dst:
+            for block in get_block_windows(new_src.height, new_src.width, block_width, block_height):
+                print('Predict block (xoff, yoff, xsize, ysize): (%d, %d, %d, %d) of %s' % (block + (new_img_path,)))
+                valid_mask = get_block_valid_mask(old_src, new_src, block, aoi_polygons) if b_mask else None
+                change_block = predict_one_block(model, device, old_src, new_src, block, trans, win_size=win_size,
+                                                 batch_size=batch_size, b_dense=b_dense, old_features=old_features,
+                                                 valid_mask=valid_mask)
+                dst.write(change_block, 1, window=Window(*block))
+
+    print('Save prediction result to %s' % save_path)
+    return True
+
+def predict_block_worker(model_path, img_pair_list, job_queue, result_queue, win_size, batch_size, b_dense, thread_num,
+                         old_feature_path_list=None, b_mask=False, aoi_shp=None):
+    '''
+    a worker process for predict_images_parallel: load the model once, then predict blocks from job_queue until getting None
+    :param model_path: the trained model
+    :param img_pair_list: the image pair list
+    :param job_queue: each job is (pair_id, (xoff, yoff, xsize, ysize))
+    :param result_queue: put (pair_id, block, change_block), and None when this worker exits
+    :param win_size: window size of the patches
+    :param batch_size: the batch size
+    :param b_dense: if True, use NetDense
+    :param thread_num: the number of threads of torch in this process
+    :param old_feature_path_list: the cached features of the old image of each pair, None for not using
+    :param b_mask: if True, skip nodata pixels
+    :param aoi_shp: a vector file of the area of interest, skip pixels outside it
+    :return:
+    '''
+    # avoid oversubscription, all the workers share the CPU cores
+    torch.set_num_threads(thread_num)
+    device = get_prediction_device(model_path)
+    model = load_trained_model(model_path, device)
+    trans = get_transform()
+
+    src_list = {}   # pair_id: (old_src, new_src), keep the images open in this worker
+    feature_list = {}   # pair_id: cached features of the old image (memory map)
+    aoi_list = {}       # pair_id: AOI polygons in the projection of the new image
+    try:
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            pair_id, block = job
+            if pair_id not in src_list:
+                src_list[pair_id] = (rasterio.open(img_pair_list[pair_id][0]), rasterio.open(img_pair_list[pair_id][1]))
+            old_src, new_src = src_list[pair_id]
+            old_features = None
+            if old_feature_path_list is not None and old_feature_path_list[pair_id] is not None:
+                if pair_id not in feature_list:
+                    feature_list[pair_id] = np.load(old_feature_path_list[pair_id], mmap_mode='r')
+                old_features = feature_list[pair_id]
+            valid_mask = None
+            if b_mask:
+                if aoi_shp is not None and pair_id not in aoi_list:
+                    aoi_list[pair_id] = read_aoi_polygons(aoi_shp, new_src.crs)
+                valid_mask = get_block_valid_mask(old_src, new_src, block, aoi_list.get(pair_id, None))
+            change_block = predict_one_block(model, device, old_src, new_src, block, trans, win_size=win_size,
+                                             batch_size=batch_size, b_dense=b_dense, old_features=old_features,
+                                             valid_mask=valid_mask)
+            result_queue.put((pair_id, block, change_block))
+    finally:
+        for old_src, new_src in src_list.values():
+            old_src.close()
+            new_src.close()
+        result_queue.put(None)
+
+def write_block_worker(img_pair_list, save_path_list, result_queue, worker_num, block_count, nodata=None):
+    '''
+    the only process writing change maps for predict_images_parallel
+    :param img_pair_list: the image pair list, the new image is used as the reference
+    :param save_path_list: the save path for each pair
+    :param result_queue: (pair_id, block, change_block) from workers, or None when a worker exits
+    :param worker_num: the number of workers
+    :param block_count: the total number of blocks
+    :param nodata: the nodata value of the change maps
+    :return:
+    '''
+    dst_list = {}
+    finished_worker = 0
+    written_count = 0
+    try:
+        while finished_worker < worker_num:
+            result = result_queue.get()
+            if result is None:
+                finished_worker += 1
+                continue
+            pair_id, block, change_block = result
+            if pair_id not in dst_list:
+                with rasterio.open(img_pair_list[pair_id][1]) as new_src:
+                    profile = get_change_map_profile(new_src, nodata=nodata)
+                dst_list[pair_id] = rasterio.open(save_path_list[pair_id], 'w', **profile)
+            dst_list[pair_id].write(change_block, 1, window=Window(*block))
+            written_count += 1
+            print('Wrote block (xoff, yoff, xsize, ysize): (%d, %d, %d, %d) of %dth pair, %d/%d'
+                  % (block + (pair_id, written_count, block_count)))
+    finally:
+        for dst in dst_list.values():
+            dst.close()
+
+    if written_count != block_count:
+        raise ValueError('error, only %d blocks out of %d have been predicted' % (written_count, block_count))
+
+def join_processes_or_terminate(process_list, poll_interval=1.0):
+    '''
+    wait until all the processes exit. If one of them fails (raise an error, or is killed, e.g., out of memory),
+    terminate the others, because they may wait for the failed one forever (e.g., on the queues)
+    :param process_list: the started processes
+    :param poll_interval: the interval (seconds) for checking the processes
+    :return: True if all the processes exit successfully, otherwise, raise an error
+    '''
+    while True:
+        failed_list = [proc for proc in process_list if proc.exitcode is not None and proc.exitcode != 0]
+        if len(failed_list) > 0:
+            for proc in process_list:
+                if proc.is_alive():
+                    proc.terminate()
+            for proc in process_list:
+                proc.join()
+            raise ValueError('error, process %s failed (exit code: %d), terminated all processes for prediction'
+                             % (failed_list[0].name, failed_list[0].exitcode))
+        alive_list = [proc for proc in process_list if proc.exitcode is None]
+        if len(alive_list) < 1:
+            return True
+        multiprocessing.connection.wait([proc.sentinel for proc in alive_list], timeout=poll_interval)
+
+def predict_images_parallel(model_path, img_pair_list, save_path_list, process_num, win_size=28, block_width=1024,
+                            block_height=1024, batch_size=32, b_dense=False, feature_cache_dir=None,
+                            b_mask=False, aoi_shp=None, b_feature_fp16=False):
+    '''
+    predict image pairs in parallel: blocks of all pairs are put into a job queue, consumed by process_num workers,
+    each worker holds one model, the results are written by one writer process
+    :param model_path: the trained model
+    :param img_pair_list: the image pair list
+    :param save_path_list: the save path for each pair
+    :param process_num: the number of worker processes
+    :param win_size: window size of the patches
+    :param block_width: the width of a block
+    :param block_height: the height of a block
+    :param batch_size: the batch size (not used in dense prediction)
+    :param b_dense: if True, use NetDense
+    :param feature_cache_dir: a folder for caching features of old images, None for not using the cache
+    :param b_mask: if True, skip nodata pixels of the old and new image, and save them as change_map_nodata
+    :param aoi_shp: a vector file of the area of interest, skip pixels outside it (also set b_mask as True)
+    :param b_feature_fp16: if True, cache the features as float16
+    :return: True if successful
+    '''
+    b_mask = b_mask or aoi_shp is not None
+    job_list = []
+    for pair_id, image_pair in enumerate(img_pair_list):
+        img_pairs.check_image_pairs(image_pair)
+        height, width = img_pairs.get_image_height_width(image_pair[1])
+        job_list.extend([(pair_id, block) for block in get_block_windows(height, width, block_width, block_height)])
+    thread_num = max(1, multiprocessing.cpu_count() // process_num)
+
+    # compute features of the old images before starting workers, the same old image is only computed once
+    old_feature_path_list = None
+    if feature_cache_dir is not None:
+        device = get_prediction_device(model_path)
+        model = load_trained_model(model_path, device)
+        trans = get_transform()
+        old_feature_path_list = [get_old_feature_cache(model, device, image_pair[0], trans, feature_cache_dir,
+                                                       win_size=win_size, block_width=block_width,
+                                                       block_height=block_height, b_fp16=b_feature_fp16)
+                                 for image_pair in img_pair_list]
+        del model
+
+    print('predict %d blocks of %d image pairs using %d processes (%d threads each)'
+          % (len(job_list), len(img_pair_list), process_num, thread_num))
+
+    # spawn new processes, not sharing the torch state of this process
+    mp_context = multiprocessing.get_context('spawn')
+    job_queue = mp_context.Queue()
+    result_queue = mp_context.Queue(maxsize=process_num * 2)    # limit the blocks waiting for writing in memory
+    for job in job_list:
+        job_queue.put(job)
+    for _ in range(process_num):
+        job_queue.put(None)
+
+    writer = mp_context.Process(target=write_block_worker,
+                                args=(img_pair_list, save_path_list, result_queue, process_num, len(job_list),
+                                      change_map_nodata if b_mask else None))
+    writer.start()
+    workers = [mp_context.Process(target=predict_block_worker,
+                                  args=(model_path, img_pair_list, job_queue, result_queue, win_size, batch_size,
+                                        b_dense, thread_num, old_feature_path_list, b_mask, aoi_shp))
+               for _ in range(process_num)]
+    for worker in workers:
+        worker.start()
+    # the writer and the workers wait for each other on the queues, stop all of them if one fails
+    return join_processes_or_terminate([writer] + workers)
+
 def predict_small_image_or_subset(model,device,save_path, win_size,data_root,image_paths_txt,
-                                  image_pair,pair_id, height, width, trans, batch_size,num_workers, subset):
+                                  image_pair,pair_id, height, width, trans, batch_size,num_workers, subset, b_dense=False):
     '''
     predict a small image (< 1000 by 1000 pixels) or a image subset
     :param model:
@@ -178,28 +816,32 @@ def predict_small_image_or_subset(model,device,save_path, win_size,data_root,ima
     :param batch_size:
     :param num_workers:
     :param subset:
+    :param b_dense: if True, run the fully-convolutional NetDense on the entire image (or subset) instead of patch by patch
     :return:
     '''
 
-    prediction_loader = torch.utils.data.DataLoader(
-        two_images_pixel_pair(data_root, image_paths_txt, (win_size, win_size), train=False, transform=trans,
-                              predict_pair_id=pair_id, subset_boundary=subset),
-        batch_size=batch_size, num_workers=num_workers, shuffle=False)
+    if b_dense:
+        old_image_array, new_image_array = img_pairs.read_image_pair_for_prediction(image_pair, subset)
+        predicted_change_2d = predict_image_dense(model, device, old_image_array, new_image_array, trans, win_size=win_size)
+    else:
+        prediction_loader = img_pairs.get_batch_data_loader(
+            two_images_pixel_pair(data_root, image_paths_txt, (win_size, win_size), train=False, transform=trans,
+                                  predict_pair_id=pair_id, subset_boundary=subset),
+            batch_size, num_workers, shuffle=False)
 
-    predicted_change_2d = np.zeros((height, width), dtype=np.uint8)
+        predicted_change_2d = np.zeros((height, width), dtype=np.uint8)
 
-    # print('Size of DataLoader: %d'%len(prediction_loader))
-    # loading data
-    for batch_idx, (data, pos) in enumerate(prediction_loader):
+        # print('Size of DataLoader: %d'%len(prediction_loader))
+        # loading data
+        for batch_idx, (data, pos) in enumerate(prediction_loader):
 
-        for i in range(len(data)):
-            data[i] = data[i].to(device)
+            for i in range(len(data)):
+                data[i] = data[i].to(device)
 
-        out_prop = model(data)
-        predicted_target = torch.argmax(out_prop, dim=1).cpu()
+            out_prop = model(data)
+            predicted_target = torch.argmax(out_prop, dim=1).cpu()
 
-        for out_label, _, row, col in zip(predicted_target, pos[0], pos[1], pos[2]):
-            predicted_change_2d[row, col] = out_label
+            predicted_change_2d[pos[1].numpy(), pos[2].numpy()] = predicted_target.numpy()
 
     # save_path = os.path.join(save_predict_dir, "predict_change_map_%d.tif" % pair_id)
     print('Save prediction result to %s' % save_path)
@@ -212,10 +854,58 @@ def predict_small_image_or_subset(model,device,save_path, win_size,data_root,ima
     return True
 
 
+def get_transform():
+    normalize = transforms.Normalize((128,128, 128), (128, 128, 128)) # mean, std # for 3 band images with 0-255 grey
+    return transforms.Compose([ToTensor(), normalize])
+
+def is_torchscript_model(model_path):
+    '''
+    check if a model file is a TorchScript archive (from export_siamese_model.py) rather than a state dict
+    :param model_path: the model path
+    :return: True or False
+    '''
+    if zipfile.is_zipfile(model_path) is False:
+        return False
+    with zipfile.ZipFile(model_path) as z_obj:
+        return any([name.endswith('/constants.pkl') for name in z_obj.namelist()])
+
+def get_prediction_device(load_model_path):
+    '''
+    get the device for prediction: TorchScript models (from export_siamese_model.py) are traced on CPU, and the quantized
+    ones only run on CPU, so use CPU for them; for a state dict, use GPU if available
+    :param load_model_path: the model path
+    :return: the device
+    '''
+    if is_torchscript_model(load_model_path):
+        return torch.device('cpu')
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def load_trained_model(load_model_path, device):
+    '''
+    load a trained model, either a state dict of Net (saved during training) or a TorchScript model
+    (FP32 or quantized, saved by export_siamese_model.py)
+    :param load_model_path: the model path
+    :param device: the device, must be CPU for a TorchScript model, see get_prediction_device
+    :return: the model in evaluation mode
+    '''
+    if os.path.isfile(load_model_path) is False:
+        raise IOError('trained model: %s does not exist'%load_model_path)
+    if is_torchscript_model(load_model_path):
+        if torch.device(device).type != 'cpu':
+            raise ValueError('error, the TorchScript model %s (traced on CPU, may be quantized) only runs on CPU, '
+                             'but the device is %s' % (load_model_path, str(device)))
+        print('load TorchScript model: %s' % load_model_path)
+        model = torch.jit.load(load_model_path, map_location=device)
+        model.eval()
+        return model
+    model = Net().to(device)
+    model.load_state_dict(torch.load(load_model_path, map_location=device))
+    model.eval()
+    return model
+
 def main(options, args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    normalize = transforms.Normalize((128,128, 128), (128, 128, 128)) # mean, std # for 3 band images with 0-255 grey
-    trans = transforms.Compose([ToTensor(), normalize])
+    trans = get_transform()
 
     data_root = os.path.expanduser(args[0])
     image_paths_txt = os.path.expanduser(args[1])
@@ -236,33 +926,51 @@ def main(options, args):
     else:
         save_model_folder = os.getcwd()
 
-    train_loss_list = []
-    evl_loss_list = []
-    evl_acc_list = []
+    # loss, accuracy, and speed of each epoch
+    history = {'train_loss': [], 'eval_epoch': [], 'eval_loss': [], 'eval_acc': [], 'samples_per_sec': [],
+               'data_time': [], 'compute_time': []}
 
     if do_learn:  # training mode
-        train_loader = torch.utils.data.DataLoader(
-            two_images_pixel_pair(data_root, image_paths_txt, (28,28), train=True, transform=trans),
-            batch_size=batch_size, num_workers=num_workers,  shuffle=True)
-
-        test_loader = torch.utils.data.DataLoader(
-            two_images_pixel_pair(data_root, image_paths_txt, (28,28), train=True, transform=trans),
-            batch_size=batch_size, num_workers=num_workers, shuffle=False)
+        all_dataset = two_images_pixel_pair(data_root, image_paths_txt, (28,28), train=True, transform=trans,
+                                            npy_cache_dir=options.npy_cache_dir)
+        if options.valid_ratio > 0:
+            # hold out some samples for validation, the split is the same when resuming
+            train_dataset, valid_dataset = img_pairs.split_train_validation(all_dataset, options.valid_ratio)
+        else:
+            # no held-out samples, evaluate on the training samples (as before)
+            train_dataset, valid_dataset = all_dataset, all_dataset
+        valid_loader = img_pairs.get_batch_data_loader(valid_dataset, batch_size, num_workers, shuffle=False)
+        train_loader = img_pairs.get_batch_data_loader(train_dataset, batch_size, num_workers, shuffle=True)
 
         optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
-        for epoch in range(num_epochs):
-            t_loss = train(model, device, train_loader, epoch, optimizer,batch_size)
-            eval_acc, eval_loss =  test(model, device, test_loader)
 
-            train_loss_list.append(t_loss)
-            evl_loss_list.append(eval_acc)
-            evl_acc_list.append(eval_loss)
+        checkpoint_path = os.path.join(save_model_folder, 'checkpoint_latest.pt')
+        start_epoch = 0
+        if options.resume:
+            if os.path.isfile(checkpoint_path):
+                start_epoch, history = load_checkpoint(checkpoint_path, model, optimizer, device)
+            else:
+                print('warning, %s does not exist, start training from scratch' % checkpoint_path)
+
+        for epoch in range(start_epoch, num_epochs):
+            t_loss, speed_info = train(model, device, train_loader, epoch, optimizer,batch_size)
+            history['train_loss'].append(t_loss)
+            for key in ['samples_per_sec', 'data_time', 'compute_time']:
+                history[key].append(speed_info[key])
+
+            # evaluate at the interval and the last epoch
+            if (epoch + 1) % options.valid_interval == 0 or epoch == num_epochs - 1:
+                eval_acc, eval_loss = test(model, device, valid_loader)
+                history['eval_epoch'].append(epoch)
+                history['eval_acc'].append(float(eval_acc))
+                history['eval_loss'].append(float(eval_loss))
 
             if epoch % save_frequency == 0:
                 # torch.save(model, 'siamese_{:03}.pt'.format(epoch))             # save the entire model
                 model_save_path = os.path.join(save_model_folder,'siamese_{:03}.pt'.format(epoch))
                 torch.save(model.state_dict(),
                            model_save_path)  # save only the state dict, i.e. the weight
+            save_checkpoint(checkpoint_path, model, optimizer, epoch, history)
     else:  # prediction
 
         img_pair_list = read_img_pair_paths(data_root, image_paths_txt)
@@ -272,47 +980,41 @@ def main(options, args):
             save_predict_dir = options.predict_result_dir
             os.mkdir(save_predict_dir)
 
+        if options.feature_cache_dir is not None and options.dense_predict is False:
+            raise ValueError('error, caching features of old images (--feature_cache_dir) needs dense prediction (-D)')
+
+        if options.process_num > 1:
+            save_path_list = [os.path.join(save_predict_dir, "predict_change_map_%d.tif" % pair_id)
+                              for pair_id in range(len(img_pair_list))]
+            predict_images_parallel(options.load_model_path, img_pair_list, save_path_list, options.process_num,
+                                    win_size=28, block_width=options.sub_width, block_height=options.sub_height,
+                                    batch_size=batch_size, b_dense=options.dense_predict,
+                                    feature_cache_dir=options.feature_cache_dir, b_feature_fp16=options.feature_cache_fp16,
+                                    b_mask=options.mask_nodata, aoi_shp=options.aoi_shp)
+            return True
 
         with torch.no_grad():
             # loading model
             load_model_path = options.load_model_path # 'siamese_018.pt'
-            if os.path.isfile(load_model_path) is False:
-                raise IOError('trained model: %s does not exist'%load_model_path)
-            model.load_state_dict(torch.load(load_model_path))
-            model.eval()
+            device = get_prediction_device(load_model_path)
+            model = load_trained_model(load_model_path, device)
 
             for pair_id, image_pair in enumerate(img_pair_list):
                 print('Predict the %d th image'%pair_id)
 
                 # handle images with large size (> 1000 by 1000 pixels)
                 height, width = img_pairs.get_image_height_width(image_pair[0])
-                if height*width > 1000*1000:
-                    subset_w = options.sub_width
-                    subset_h = options.sub_height
-                    adj_overlay_x = options.extend_dis_x
-                    adj_overlay_y = options.extend_dis_y
-                    subset_boundaries = split_image.sliding_window(width, height, subset_w, subset_h, adj_overlay_x, adj_overlay_y)
-
-                    if len(subset_boundaries) > 1:
-                        # go through each subset,then merge them
-                        subset_file_list = []
-                        save_folder = os.path.join(save_predict_dir, "predict_change_map_%d" % pair_id)
-                        os.mkdir(save_folder)
-                        for s_idx, subset in enumerate(subset_boundaries):
-
-                            # subset:  (xoff, yoff, xsize, ysize)
-                            xsize, ysize = subset[2], subset[3]  # new width and height
-
-                            save_path = os.path.join(save_folder,'%d.tif'%s_idx)
-                            predict_small_image_or_subset(model, device, save_path, 28, data_root, image_paths_txt,
-                                                          image_pair, pair_id,
-                                                          ysize, xsize, trans, batch_size, num_workers, subset)
-                            subset_file_list.append(save_path)
-                            pass
-
-                        # mosaic
-                        save_path = os.path.join(save_predict_dir, "predict_change_map_%d.tif" % pair_id)
-                        RSImageProcess.mosaics_images(subset_file_list,save_path,0)
+                # caching features of the old image and skipping invalid pixels are in the block-by-block path
+                if height*width > 1000*1000 or options.feature_cache_dir is not None or options.mask_nodata \
+                        or options.aoi_shp is not None:
+                    # read, predict, and save block by block
+                    save_path = os.path.join(save_predict_dir, "predict_change_map_%d.tif" % pair_id)
+                    predict_large_image_by_blocks(model, device, image_pair, save_path, trans, win_size=28,
+                                                  block_width=options.sub_width, block_height=options.sub_height,
+                                                  batch_size=batch_size, b_dense=options.dense_predict,
+                                                  feature_cache_dir=options.feature_cache_dir,
+                                                  b_feature_fp16=options.feature_cache_fp16,
+                                                  b_mask=options.mask_nodata, aoi_shp=options.aoi_shp)
 
                     # skip the remaining codes
                     continue
@@ -321,7 +1023,8 @@ def main(options, args):
                 # predict a small image
                 save_path = os.path.join(save_predict_dir, "predict_change_map_%d.tif" % pair_id)
                 predict_small_image_or_subset(model,device,save_path,28,data_root,image_paths_txt,image_pair,pair_id,
-                                              height,width,trans,batch_size,num_workers,None)
+                                              height,width,trans,batch_size,num_workers,None,
+                                              b_dense=options.dense_predict)
 
 
 
@@ -358,6 +1061,19 @@ if __name__ == "__main__":
                       action="store", dest = 'save_frequency',
                       help='the frequency for saving traned model')
 
+    parser.add_option('-r', '--resume',
+                      action="store_true", dest='resume', default=False,
+                      help='resume training from the checkpoint (checkpoint_latest.pt) in the folder for saving model')
+
+    parser.add_option('-V', '--valid_ratio', type = float, default = 0,
+                      action="store", dest='valid_ratio',
+                      help='the ratio of samples held out for validation during training, '
+                           '0 for evaluating on the training samples')
+
+    parser.add_option('-I', '--valid_interval', type = int, default = 1,
+                      action="store", dest='valid_interval',
+                      help='evaluate on the validation (or training) samples every N epochs')
+
     parser.add_option('-m', '--load_model_path',
                       action="store", dest = 'load_model_path',
                       help='the trained model for prediction')
@@ -372,16 +1088,49 @@ if __name__ == "__main__":
 
     parser.add_option("-W", "--sub_width",type = int, default = 1024,
                       action="store", dest="sub_width",
-                      help="the width of wanted subsets")
+                      help="the width of blocks for predicting a large image")
     parser.add_option("-H", "--sub_height", type = int, default = 1024,
                       action="store", dest="sub_height",
-                      help="the height of wanted subsets")
+                      help="the height of blocks for predicting a large image")
+    # deprecated, blocks are read with a halo of half the window size, no need to extend subsets. Kept (not used) so
+    # that old scripts passing them still work
     parser.add_option("-X", "--extend_dis_x",type=int,default = 14,
                       action="store", dest="extend_dis_x",
-                      help="extend distance in x direction (pixels) of the subset to adjacent subset, make subsets overlay each other")
+                      help="deprecated, not used (blocks are read with a halo of half the window size)")
     parser.add_option("-Y", "--extend_dis_y", type=int, default=14,
                       action="store", dest="extend_dis_y",
-                      help="extend distance in y direction (pixels) of the subset to adjacent subset, make subsets overlay each other")
+                      help="deprecated, not used (blocks are read with a halo of half the window size)")
+
+    parser.add_option("-D", "--dense_predict",
+                      action="store_true", dest="dense_predict", default=False,
+                      help="set this flag for predicting with the fully-convolutional network (much faster, the same results)")
+
+    parser.add_option("-c", "--npy_cache_dir",
+                      action="store", dest="npy_cache_dir",
+                      help="the folder for caching training images as .npy files, then open them as memory maps")
+
+    parser.add_option("-F", "--feature_cache_dir",
+                      action="store", dest="feature_cache_dir",
+                      help="the folder for caching features of old images, reused when comparing one old image "
+                           "with several new images (need -D, about 2 KB disk space per pixel)")
+
+    parser.add_option("", "--feature_cache_fp16",
+                      action="store_true", dest="feature_cache_fp16", default=False,
+                      help="cache features as float16 (about 1 KB per pixel), the change maps may be slightly different "
+                           "from the ones without the cache")
+
+    parser.add_option("-M", "--mask_nodata",
+                      action="store_true", dest="mask_nodata", default=False,
+                      help="skip nodata pixels (nodata value, mask or alpha band) of images, "
+                           "save them as %d in the change maps" % change_map_nodata)
+
+    parser.add_option("-A", "--aoi_shp",
+                      action="store", dest="aoi_shp",
+                      help="a shapefile of the area of interest, skip pixels outside it (also skip nodata pixels)")
+
+    parser.add_option("-P", "--process_num", type=int, default=1,
+                      action="store", dest="process_num",
+                      help="the number of processes for prediction, each one predicts blocks of images")
 
     # parser.add_option("-p", "--para",
 
@@ -401,4 +1150,7 @@ if __name__ == "__main__":
     # else:
     #     parameters.set_saved_parafile_path(options.para_file)
 
+    if '-X' in sys.argv or '-Y' in sys.argv or any([item.startswith('--extend_dis_') for item in sys.argv]):
+        print('warning, -X/--extend_dis_x and -Y/--extend_dis_y are deprecated and not used')
+
     main(options, args)